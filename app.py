@@ -1,29 +1,67 @@
 import os
 import json
+import time
+import queue
+import threading
 import tkinter as tk
-from tkinter import filedialog, messagebox, colorchooser
-from PIL import Image, ImageTk, ImageDraw, ImageFont
-
-SUPPORTED_FORMATS = ['.jpg', '.jpeg', '.png', '.bmp', '.tiff']
-TEMPLATE_FILE = "templates.json"
+from tkinter import ttk, filedialog, messagebox, colorchooser
+from PIL import ImageTk
+import watermark_engine as engine
+from watermark_engine import TEMPLATE_FILE
+from export_manifest import ExportManifest
+from catalog import Catalog, scan_batches
+from thumbnails import ThumbnailCache, ThumbnailService, PREFETCH_RADIUS
+
+PREVIEW_SIZE = (400, 400)
+PREVIEW_CENTER = (200, 200)  # 预览图中心在画布上的位置
+NO_RENDITIONS = "不使用"
+PREVIEW_DELAY_MS = 40  # 连续输入事件合并为一次预览渲染的等待时间
+EXPORT_POLL_MS = 100  # 主线程读取后台导出进度的间隔
+SCAN_POLL_MS = 50  # 主线程读取后台扫描结果的间隔
+THUMBNAIL_POLL_MS = 15  # 等待后台缩略图生成时的检查间隔
 
 class SimpleWatermarkApp:
     def __init__(self, root):
         self.root = root
         self.root.title("水印工具 - 带字体大小调节版")
-        self.images = []
-        self.current_image = None
+        self.catalog = Catalog()
+        self.scan_queue = queue.Queue()
+        self.scanning = 0
         self.current_path = None
+        self.current_size = None
+        self.preview_proxy = None
+        self.preview_scale = 1.0
+        self._preview_job = None
+        # 装有 numpy 时预览和导出都直接在 RGB 图像上混合水印，不做整幅 RGBA 转换
+        self.backend = engine.preferred_backend()
+        # 预览代理图在后台线程生成并写入磁盘缓存，缓存目录不可用时只用内存缓存
+        try:
+            thumbnail_cache = ThumbnailCache()
+        except OSError:
+            thumbnail_cache = None
+        self.thumbnails = ThumbnailService(PREVIEW_SIZE, native=self.backend=="numpy", cache=thumbnail_cache)
+        self.root.protocol("WM_DELETE_WINDOW", self.on_close)
         self.current_color = (255, 255, 255)
+        self.auto_color = tk.BooleanVar(value=False)
         self.shadow_enabled = tk.BooleanVar(value=False)
         self.outline_enabled = tk.BooleanVar(value=False)
         self.watermark_pos = [0, 0]
-        self.drag_data = {"x": 0, "y": 0}
+        self.drag_data = {}
+        self.tk_base = None
+
+        # 启动时查找一次字体，之后预览和导出都从字体缓存中取
+        try:
+            engine.find_font_path()
+        except RuntimeError as e:
+            messagebox.showerror("错误", str(e))
 
         # ===== 左侧列表 =====
-        self.listbox = tk.Listbox(root, width=40)
-        self.listbox.pack(side=tk.LEFT, fill=tk.Y)
-        self.listbox.bind("<<ListboxSelect>>", self.show_preview)
+        left_frame = tk.Frame(root)
+        left_frame.pack(side=tk.LEFT, fill=tk.Y)
+        self.file_list = VirtualList(left_frame, self.catalog, self.show_preview)
+        self.file_list.pack(side=tk.TOP, fill=tk.BOTH, expand=True)
+        self.scan_label = tk.Label(left_frame, text="", anchor="w")
+        self.scan_label.pack(side=tk.TOP, fill=tk.X)
 
         # ===== 右侧滚动面板 =====
         right_container = tk.Frame(root)
@@ -48,6 +86,7 @@ class SimpleWatermarkApp:
         self.canvas.pack(fill=tk.BOTH, expand=False)
         self.canvas.bind("<ButtonPress-1>", self.start_drag)
         self.canvas.bind("<B1-Motion>", self.drag_watermark)
+        self.canvas.bind("<ButtonRelease-1>", self.stop_drag)
 
         # ===== 控制区 =====
         ctrl_frame = tk.Frame(self.scrollable_frame)
@@ -56,6 +95,19 @@ class SimpleWatermarkApp:
         tk.Button(ctrl_frame, text="导入文件夹", command=self.add_folder).pack(side=tk.LEFT)
         tk.Button(ctrl_frame, text="导出当前图片", command=self.export_current_image).pack(side=tk.LEFT)
         tk.Button(ctrl_frame, text="导出全部图片", command=self.export_all_images).pack(side=tk.LEFT)
+        self.cancel_button = tk.Button(ctrl_frame, text="取消导出", command=self.cancel_export, state=tk.DISABLED)
+        self.cancel_button.pack(side=tk.LEFT)
+
+        # ===== 导出进度 =====
+        progress_frame = tk.Frame(self.scrollable_frame)
+        progress_frame.pack(fill=tk.X)
+        self.progress_bar = ttk.Progressbar(progress_frame, orient="horizontal", mode="determinate", length=300)
+        self.progress_bar.pack(side=tk.LEFT)
+        self.progress_label = tk.Label(progress_frame, text="")
+        self.progress_label.pack(side=tk.LEFT)
+        self.export_queue = queue.Queue()
+        self.export_thread = None
+        self.cancel_event = threading.Event()
 
         # ===== 水印设置 =====
         settings_frame = tk.LabelFrame(self.scrollable_frame, text="水印设置")
@@ -65,7 +117,7 @@ class SimpleWatermarkApp:
         self.text_entry = tk.Entry(settings_frame, width=20)
         self.text_entry.insert(0, "示例水印")
         self.text_entry.grid(row=0, column=1)
-        self.text_entry.bind("<KeyRelease>", lambda e: self.update_preview())
+        self.text_entry.bind("<KeyRelease>", lambda e: self.schedule_preview())
 
         # ==== 颜色 + 字体大小 ====
         tk.Label(settings_frame, text="颜色：").grid(row=0, column=2, sticky="w")
@@ -73,8 +125,9 @@ class SimpleWatermarkApp:
 
         tk.Label(settings_frame, text="字体大小(%)：").grid(row=0, column=4, sticky="w")
         self.font_size_var = tk.DoubleVar(value=5.0)
-        self.font_size_scale = tk.Scale(settings_frame, from_=1, to=20, resolution=0.5, orient="horizontal",
-                                        variable=self.font_size_var, command=lambda e: self.update_preview())
+        self.font_size_scale = tk.Scale(settings_frame, from_=engine.FONT_SIZE_RANGE[0], to=engine.FONT_SIZE_RANGE[1],
+                                        resolution=0.5, orient="horizontal",
+                                        variable=self.font_size_var, command=lambda e: self.schedule_preview())
         self.font_size_scale.grid(row=0, column=5, sticky="we")
 
         self.font_size_entry = tk.Entry(settings_frame, width=5)
@@ -86,17 +139,32 @@ class SimpleWatermarkApp:
 
         tk.Label(settings_frame, text="透明度(%)：").grid(row=1, column=0, sticky="w")
         self.alpha_scale = tk.Scale(settings_frame, from_=0, to=100, orient="horizontal",
-                                    command=lambda e: self.update_preview())
+                                    command=lambda e: self.schedule_preview())
         self.alpha_scale.set(50)
         self.alpha_scale.grid(row=1, column=1, sticky="we")
+        # 自动颜色：按水印所在区域的亮度选黑色或白色
+        tk.Checkbutton(settings_frame, text="自动颜色", variable=self.auto_color,
+                       command=self.update_preview).grid(row=1, column=2, columnspan=2, sticky="w")
 
         tk.Label(settings_frame, text="位置：").grid(row=2, column=0, sticky="w")
         self.position_var = tk.StringVar(value="center")
-        position_options = ["left_top", "right_top", "center", "left_bottom", "right_bottom"]
-        self.position_menu = tk.OptionMenu(settings_frame, self.position_var, *position_options,
+        self.position_menu = tk.OptionMenu(settings_frame, self.position_var, *engine.POSITIONS,
                                            command=self.set_position)
         self.position_menu.grid(row=2, column=1, sticky="we")
 
+        # 平铺（tile）模式：间距占原图高度的百分比，角度为逆时针旋转角度
+        tk.Label(settings_frame, text="平铺间距(%)：").grid(row=2, column=2, sticky="w")
+        self.tile_spacing_scale = tk.Scale(settings_frame, from_=engine.TILE_SPACING_RANGE[0], to=engine.TILE_SPACING_RANGE[1],
+                                           resolution=0.5, orient="horizontal",
+                                           command=lambda e: self.schedule_preview())
+        self.tile_spacing_scale.set(engine.DEFAULT_SETTINGS["tile_spacing"])
+        self.tile_spacing_scale.grid(row=2, column=3, columnspan=3, sticky="we")
+        tk.Label(settings_frame, text="平铺角度：").grid(row=3, column=2, sticky="w")
+        self.tile_angle_scale = tk.Scale(settings_frame, from_=-90, to=90, orient="horizontal",
+                                         command=lambda e: self.schedule_preview())
+        self.tile_angle_scale.set(engine.DEFAULT_SETTINGS["tile_angle"])
+        self.tile_angle_scale.grid(row=3, column=3, columnspan=3, sticky="we")
+
         tk.Checkbutton(settings_frame, text="阴影", variable=self.shadow_enabled,
                        command=self.update_preview).grid(row=3, column=0, sticky="w")
         tk.Checkbutton(settings_frame, text="描边", variable=self.outline_enabled,
@@ -139,33 +207,36 @@ class SimpleWatermarkApp:
 
         tk.Label(export_frame, text="导出格式：").grid(row=4, column=0, sticky="w")
         self.format_var = tk.StringVar(value="PNG")
-        format_menu = tk.OptionMenu(export_frame, self.format_var, "PNG", "JPEG")
+        format_menu = tk.OptionMenu(export_frame, self.format_var, *engine.OUTPUT_FORMATS)
         format_menu.grid(row=4, column=1, sticky="we")
 
+        # 编码档位：fast 速度优先，archive 体积优先，可在 templates.json 的 _encoder_profiles 中调整
+        tk.Label(export_frame, text="编码档位：").grid(row=5, column=0, sticky="w")
+        self.encoder_var = tk.StringVar(value="default")
+        encoder_menu = tk.OptionMenu(export_frame, self.encoder_var,
+                                     *engine.load_encoder_profiles(self.templates))
+        encoder_menu.grid(row=5, column=1, sticky="we")
+
+        self.incremental_enabled = tk.BooleanVar(value=True)
+        tk.Checkbutton(export_frame, text="增量导出（跳过未变化的图片）", variable=self.incremental_enabled)\
+            .grid(row=6, column=0, columnspan=2, sticky="w")
+
+        # 多规格导出：templates.json 的 _renditions 中每个列表给出多组模板/尺寸/格式，每张图片只解码一次
+        tk.Label(export_frame, text="多规格导出：").grid(row=7, column=0, sticky="w")
+        self.renditions_var = tk.StringVar(value=NO_RENDITIONS)
+        renditions_menu = tk.OptionMenu(export_frame, self.renditions_var, NO_RENDITIONS,
+                                        *self.templates.get("_renditions", {}))
+        renditions_menu.grid(row=7, column=1, sticky="we")
+
         # 自动加载上一次模板
         last_tpl = self.templates.get("_last_used")
         if last_tpl:
             self.load_template(last_tpl)
 
-    # ===== 字体选择 =====
-    def get_font(self, img_height):
-        percent = self.font_size_var.get() / 100.0
-        font_size = max(12, int(img_height * percent))
-        win_font = "C:\\Windows\\Fonts\\msyh.ttc"
-        if os.path.exists(win_font):
-            return ImageFont.truetype(win_font, font_size)
-        linux_font = "/usr/share/fonts/truetype/noto/NotoSansCJK-Regular.ttc"
-        if os.path.exists(linux_font):
-            return ImageFont.truetype(linux_font, font_size)
-        mac_font = "/System/Library/Fonts/STHeiti Medium.ttc"
-        if os.path.exists(mac_font):
-            return ImageFont.truetype(mac_font, font_size)
-        raise RuntimeError("未找到可用的TrueType字体，请安装中文字体")
-
     def update_font_size_from_entry(self, event=None):
         try:
             val = float(self.font_size_entry.get())
-            if 1 <= val <= 20:
+            if engine.FONT_SIZE_RANGE[0] <= val <= engine.FONT_SIZE_RANGE[1]:
                 self.font_size_var.set(val)
                 self.update_preview()
         except ValueError:
@@ -174,145 +245,183 @@ class SimpleWatermarkApp:
     # ===== 图片导入 =====
     def add_images(self):
         files = filedialog.askopenfilenames(title="选择图片",
-                                            filetypes=[("Images", "*.jpg *.jpeg *.png *.bmp *.tiff")])
+                                            filetypes=[("Images", " ".join("*" + ext for ext in engine.SUPPORTED_FORMATS))])
         self.add_image_list(files)
 
     def add_folder(self):
+        """在后台线程中递归扫描文件夹，扫到的图片分批加入列表，不用等整个目录树扫完"""
         folder = filedialog.askdirectory(title="选择文件夹")
-        if folder:
-            files = [os.path.join(folder, f) for f in os.listdir(folder)
-                     if os.path.splitext(f)[1].lower() in SUPPORTED_FORMATS]
-            self.add_image_list(files)
+        if not folder:
+            return
+        self.scanning += 1
+        threading.Thread(target=self._scan_worker, args=(folder,), daemon=True).start()
+        if self.scanning == 1:
+            self.root.after(SCAN_POLL_MS, self.poll_scan_queue)
+
+    def _scan_worker(self, folder):
+        try:
+            for batch in scan_batches(folder):
+                self.scan_queue.put(batch)
+        finally:
+            self.scan_queue.put(None)
+
+    def poll_scan_queue(self):
+        try:
+            while True:
+                batch = self.scan_queue.get_nowait()
+                if batch is None:
+                    self.scanning -= 1
+                else:
+                    self.add_image_list(batch)
+        except queue.Empty:
+            pass
+        if self.scanning:
+            self.scan_label.configure(text=f"正在扫描… 已找到 {len(self.catalog)} 张")
+            self.root.after(SCAN_POLL_MS, self.poll_scan_queue)
+        else:
+            self.scan_label.configure(text=f"共 {len(self.catalog)} 张")
 
     def add_image_list(self, files):
-        for f in files:
-            if f not in self.images:
-                self.images.append(f)
-                self.listbox.insert(tk.END, os.path.basename(f))
+        """加入路径或 (路径, stat)，重复的图片只保留一份"""
+        if self.catalog.extend(files):
+            self.file_list.refresh()
 
     # ===== 预览 =====
-    def show_preview(self, event):
-        if not self.listbox.curselection():
+    def show_preview(self, idx):
+        """预览只用缩小后的代理图，原图到导出时才解码；代理图已生成时立即显示"""
+        path = self.current_path = self.catalog[idx]
+        item = self.thumbnails.cached(path)
+        future = None if item is not None else self.thumbnails.request(path)
+        # 先提交当前图片，再为前后相邻的条目预取，上下翻看时不用等待解码
+        neighbours = [self.catalog[i] for d in range(1, PREFETCH_RADIUS + 1) for i in (idx + d, idx - d)
+                      if 0 <= i < len(self.catalog)]
+        self.thumbnails.prefetch(neighbours, keep=path)
+        if item is not None:
+            self.set_proxy(item)
             return
-        idx = self.listbox.curselection()[0]
-        self.current_path = self.images[idx]
-        self.current_image = Image.open(self.current_path).convert("RGBA")
+        self.preview_proxy = None
+        self.canvas.delete("all")
+        self.canvas.create_text(200, 200, text="正在加载预览…")
+        self.root.after(THUMBNAIL_POLL_MS, self.poll_thumbnail, path, future)
+
+    def on_close(self):
+        self.thumbnails.shutdown()
+        self.root.destroy()
+
+    def poll_thumbnail(self, path, future):
+        if path != self.current_path:
+            return  # 已经选中了其他图片
+        if not future.done():
+            self.root.after(THUMBNAIL_POLL_MS, self.poll_thumbnail, path, future)
+            return
+        error = None if future.cancelled() else future.exception()
+        if future.cancelled():
+            # 预取被取消后又被选中，重新提交
+            future = self.thumbnails.request(path)
+            self.root.after(THUMBNAIL_POLL_MS, self.poll_thumbnail, path, future)
+        elif error is not None:
+            self.canvas.delete("all")
+            self.canvas.create_text(200, 200, text=f"❌ 无法预览：{error}", width=380)
+        else:
+            self.set_proxy(future.result())
+
+    def set_proxy(self, item):
+        self.preview_proxy, self.current_size = item
+        self.preview_scale = self.preview_proxy.width / self.current_size[0]
         self.watermark_pos = None
+        self.tk_base = None
+        self.drag_data = {}
         self.update_preview()
 
     def set_position(self, val):
         self.watermark_pos = None
         self.update_preview()
 
+    def schedule_preview(self):
+        """合并短时间内的多次输入，只渲染最后一次的状态"""
+        if self._preview_job is not None:
+            self.root.after_cancel(self._preview_job)
+        self._preview_job = self.root.after(PREVIEW_DELAY_MS, self.update_preview)
+
     def update_preview(self):
-        if self.current_image is None:
-            return
-        text = self.text_entry.get()
-        alpha = self.alpha_scale.get() / 100.0
-        pos_to_use = self.watermark_pos if self.watermark_pos else self.position_var.get()
-        preview_img = self.apply_watermark(self.current_image, text, alpha, pos_to_use,
-                                           font=self.get_font(self.current_image.height),
-                                           color=self.current_color,
-                                           shadow=self.shadow_enabled.get(),
-                                           outline=self.outline_enabled.get())
-        preview_resized = preview_img.copy()
-        preview_resized.thumbnail((400, 400))
-        self.tk_preview = ImageTk.PhotoImage(preview_resized)
+        if self._preview_job is not None:
+            self.root.after_cancel(self._preview_job)
+            self._preview_job = None
+        if self.preview_proxy is None or self.drag_data:
+            return  # 拖动过程中不渲染，松开鼠标时再渲染
+        # 坐标、字号和边距都按原图计算后缩放到代理图上，与导出时的换算一致
+        preview_img = engine.watermark_for_size(self.preview_proxy, self.current_settings(use_drag=True),
+                                                self.current_size)
+        self.tk_preview = ImageTk.PhotoImage(preview_img)
         self.canvas.delete("all")
-        self.canvas.create_image(200, 200, image=self.tk_preview)
-
-    # ===== 水印绘制 =====
-    def apply_watermark(self, image, text, alpha, position, font=None, color=(255, 255, 255),
-                        shadow=False, outline=False):
-        img = image.copy()
-        txt_layer = Image.new("RGBA", img.size, (255, 255, 255, 0))
-        draw = ImageDraw.Draw(txt_layer)
-
-        if font is None:
-            font = self.get_font(img.height)
+        self.canvas.create_image(*self.preview_origin(), image=self.tk_preview, anchor="nw")
 
-        text_size = draw.textbbox((0, 0), text, font=font)
-        text_w, text_h = text_size[2] - text_size[0], text_size[3] - text_size[1]
-        margin = 20
-
-        if isinstance(position, tuple):
-            pos = position
-        else:
-            if position == "left_top":
-                pos = (margin, margin)
-            elif position == "right_top":
-                pos = (img.width - text_w - margin, margin)
-            elif position == "left_bottom":
-                pos = (margin, img.height - text_h - margin)
-            elif position == "right_bottom":
-                pos = (img.width - text_w - margin, img.height - text_h - margin)
-            else:
-                pos = ((img.width - text_w) // 2, (img.height - text_h) // 2)
-
-        if shadow:
-            shadow_color = (0, 0, 0, int(255 * alpha))
-            draw.text((pos[0]+2, pos[1]+2), text, font=font, fill=shadow_color)
-        if outline:
-            outline_color = (0, 0, 0, int(255*alpha))
-            offsets = [(-1,0),(1,0),(0,-1),(0,1)]
-            for dx,dy in offsets:
-                draw.text((pos[0]+dx,pos[1]+dy), text, font=font, fill=outline_color)
-
-        rgba = (*color, int(255 * alpha))
-        draw.text(pos, text, font=font, fill=rgba)
-        return Image.alpha_composite(img, txt_layer)
+    def preview_origin(self):
+        """代理图左上角在画布上的坐标"""
+        return (PREVIEW_CENTER[0] - self.preview_proxy.width // 2,
+                PREVIEW_CENTER[1] - self.preview_proxy.height // 2)
 
     # ===== 拖拽 =====
     def start_drag(self, event):
-        self.drag_data["x"] = event.x
-        self.drag_data["y"] = event.y
+        """按下鼠标时把不带水印的代理图和水印贴图分成两个画布对象，拖动时只移动贴图"""
+        settings = self.current_settings(use_drag=True)
+        if self.preview_proxy is None or settings["position"] == "tile":
+            return  # 平铺水印铺满整幅图像，不能拖动
+        sprite, (ox, oy), pos = engine.layout_text(self.preview_proxy.size, settings, self.current_size,
+                                                   image=self.preview_proxy)
+        if self.tk_base is None:
+            self.tk_base = ImageTk.PhotoImage(self.preview_proxy)
+        self.tk_sprite = ImageTk.PhotoImage(sprite)
+        left, top = self.preview_origin()
+        self.canvas.delete("all")
+        self.canvas.create_image(left, top, image=self.tk_base, anchor="nw")
+        self.canvas.create_image(left + pos[0] + ox, top + pos[1] + oy, image=self.tk_sprite, anchor="nw",
+                                 tags="overlay")
+        self.drag_data = {"start": (event.x, event.y), "last": (event.x, event.y), "pos": pos}
 
     def drag_watermark(self, event):
-        if self.current_image is None:
+        if not self.drag_data:
+            return
+        last_x, last_y = self.drag_data["last"]
+        self.canvas.move("overlay", event.x - last_x, event.y - last_y)
+        self.drag_data["last"] = (event.x, event.y)
+
+    def stop_drag(self, event):
+        """松开鼠标时把代理图上的文字坐标换算回原图坐标，只渲染一次"""
+        if not self.drag_data:
             return
-        dx = event.x - self.drag_data["x"]
-        dy = event.y - self.drag_data["y"]
-        if self.watermark_pos is None:
-            self.watermark_pos = ((self.current_image.width - 100)//2, (self.current_image.height-30)//2)
-        x = self.watermark_pos[0] + dx
-        y = self.watermark_pos[1] + dy
-        self.watermark_pos = (x, y)
-        self.drag_data["x"] = event.x
-        self.drag_data["y"] = event.y
+        drag, self.drag_data = self.drag_data, {}
+        dx, dy = event.x - drag["start"][0], event.y - drag["start"][1]
+        if dx or dy:
+            x, y = drag["pos"][0] + dx, drag["pos"][1] + dy
+            self.watermark_pos = (round(x / self.preview_scale), round(y / self.preview_scale))
         self.update_preview()
 
     # ===== 其他导出逻辑同原版 =====
-    def resize_image(self, img):
-        mode = self.scale_mode.get()
-        try:
-            value = float(self.scale_value.get())
-        except ValueError:
-            return img
-        if value <= 0 or mode=="none":
-            return img
-        w,h = img.size
-        if mode=="width":
-            new_w=int(value)
-            new_h=int(h*new_w/w)
-        elif mode=="height":
-            new_h=int(value)
-            new_w=int(w*new_h/h)
-        elif mode=="percent":
-            scale=value/100.0
-            new_w=int(w*scale)
-            new_h=int(h*scale)
-        else:
-            return img
-        return img.resize((new_w,new_h),Image.LANCZOS)
-
-    def save_image(self, img, out_path, fmt):
-        if fmt.upper()=="JPEG":
-            img.convert("RGB").save(out_path,format="JPEG",quality=95)
-        else:
-            img.save(out_path,format="PNG")
+    def current_settings(self,use_drag=False):
+        """当前界面上的水印与导出设置，字段与模板一致；use_drag 时优先使用拖拽坐标"""
+        position=self.watermark_pos if use_drag and self.watermark_pos else self.position_var.get()
+        return engine.normalize_settings({
+            "text":self.text_entry.get(),
+            "color":"auto" if self.auto_color.get() else self.current_color,
+            "alpha":self.alpha_scale.get(),
+            "font_size":self.font_size_var.get(),
+            "position":position,
+            "tile_spacing":self.tile_spacing_scale.get(),
+            "tile_angle":self.tile_angle_scale.get(),
+            "shadow":self.shadow_enabled.get(),
+            "outline":self.outline_enabled.get(),
+            "scale_mode":self.scale_mode.get(),
+            "scale_value":self.scale_value.get(),
+            "prefix":self.prefix_entry.get(),
+            "suffix":self.suffix_entry.get(),
+            "format":self.format_var.get(),
+            "encoder":self.encoder_var.get(),
+            "backend":self.backend
+        },engine.load_encoder_profiles(self.templates))
 
     def export_current_image(self):
-        if self.current_image is None:
+        if self.current_path is None:
             messagebox.showwarning("提示","请先选择一张图片！")
             return
         out_dir=filedialog.askdirectory(title="选择导出文件夹")
@@ -321,60 +430,152 @@ class SimpleWatermarkApp:
         if os.path.abspath(os.path.dirname(self.current_path))==os.path.abspath(out_dir):
             messagebox.showerror("错误","禁止导出到原图片所在文件夹！")
             return
-        text=self.text_entry.get()
-        alpha=self.alpha_scale.get()/100.0
-        position=self.watermark_pos if self.watermark_pos else self.position_var.get()
-        prefix=self.prefix_entry.get()
-        suffix=self.suffix_entry.get()
-        fmt=self.format_var.get()
-
-        out_img=self.apply_watermark(self.current_image,text,alpha,position,
-                                     font=self.get_font(self.current_image.height),
-                                     color=self.current_color,
-                                     shadow=self.shadow_enabled.get(),
-                                     outline=self.outline_enabled.get())
-        out_img=self.resize_image(out_img)
-        name,_=os.path.splitext(os.path.basename(self.current_path))
-        out_path=os.path.join(out_dir,f"{prefix}{name}{suffix}.{fmt.lower()}")
-        self.save_image(out_img,out_path,fmt)
-        messagebox.showinfo("导出成功",f"已导出：{out_path}")
+        self.start_export([self.current_path],out_dir,self.current_settings(use_drag=True),workers=1)
 
     def export_all_images(self):
-        if not self.images:
+        if not self.catalog:
             messagebox.showwarning("提示","请先导入图片！")
             return
         out_dir=filedialog.askdirectory(title="选择导出文件夹")
         if not out_dir:
             return
-        prefix=self.prefix_entry.get()
-        suffix=self.suffix_entry.get()
-        text=self.text_entry.get()
-        alpha=self.alpha_scale.get()/100.0
-        fmt=self.format_var.get()
-        count=0
-        for path in self.images:
-            if os.path.abspath(os.path.dirname(path))==os.path.abspath(out_dir):
-                messagebox.showerror("错误",f"文件 {os.path.basename(path)} 位于输出目录中，导出已取消！")
+        conflict=engine.check_output_dir(self.catalog,out_dir)
+        if conflict:
+            messagebox.showerror("错误",f"文件 {os.path.basename(conflict)} 位于输出目录中，导出已取消！")
+            return
+        # 批量导出固定使用锚点位置（拖拽坐标只对当前图片有意义）
+        settings=self.current_settings()
+        spec=self.renditions_var.get()
+        if spec!=NO_RENDITIONS:
+            # 没有引用模板的目标以界面上的当前设置为基础；多规格导出不做增量判断
+            try:
+                targets=engine.rendition_settings(self.templates,self.templates.get("_renditions",{}).get(spec,[]),
+                                                  engine.load_encoder_profiles(self.templates),base=settings)
+            except ValueError as e:
+                messagebox.showerror("错误",str(e))
                 return
-            img=Image.open(path).convert("RGBA")
-            position=self.position_var.get()
-            out_img=self.apply_watermark(img,text,alpha,position,
-                                         font=self.get_font(img.height),
-                                         color=self.current_color,
-                                         shadow=self.shadow_enabled.get(),
-                                         outline=self.outline_enabled.get())
-            out_img=self.resize_image(out_img)
-            name,_=os.path.splitext(os.path.basename(path))
-            out_path=os.path.join(out_dir,f"{prefix}{name}{suffix}.{fmt.lower()}")
-            self.save_image(out_img,out_path,fmt)
-            count+=1
-        messagebox.showinfo("导出完成",f"成功导出 {count} 张图片到：\n{out_dir}")
+        else:
+            targets=None
+        # 不同图片导出后同名（如 a.jpg 与 a.png）时会互相覆盖，导出前就拒绝
+        duplicate=engine.check_output_names(list(self.catalog),out_dir,targets or settings)
+        if duplicate:
+            messagebox.showerror("错误",engine.duplicate_output_error(duplicate))
+            return
+        if targets:
+            self.start_export(list(self.catalog),out_dir,settings,renditions=targets)
+            return
+        manifest=ExportManifest(out_dir) if self.incremental_enabled.get() else None
+        self.start_export(list(self.catalog),out_dir,settings,manifest=manifest)
+
+    # ===== 后台导出 =====
+    def start_export(self,paths,out_dir,settings,manifest=None,workers=None,renditions=None):
+        """在后台线程中导出，界面保持响应；进度通过队列交给主线程显示"""
+        if self.export_thread is not None and self.export_thread.is_alive():
+            messagebox.showwarning("提示","正在导出，请等待完成或先取消！")
+            return
+        self.cancel_event=threading.Event()
+        self.progress_bar.configure(maximum=len(paths),value=0)
+        self.progress_label.configure(text=f"0/{len(paths)}")
+        self.cancel_button.configure(state=tk.NORMAL)
+        self.export_thread=threading.Thread(target=self._export_worker,
+                                            args=(paths,out_dir,settings,manifest,workers,self.cancel_event,
+                                                  renditions),
+                                            daemon=True)
+        self.export_thread.start()
+        self.root.after(EXPORT_POLL_MS,self.poll_export_queue)
+
+    def _export_worker(self,paths,out_dir,settings,manifest,workers,cancel_event,renditions=None):
+        """后台线程：驱动导出引擎（多进程流水线，读取、渲染、编码在各进程间重叠进行），
+        每完成一个文件就把进度和吞吐量放进队列；这里不能直接操作 Tk 控件"""
+        summary={"count":0,"skipped":0,"failed":[],"orphans":[],"out_dir":out_dir,"out_path":None,
+                 "total":len(paths),"cancelled":False,"encoded":""}
+        start=time.perf_counter()
+        bytes_read=0
+        # 按文件头估计每张图的内存，同时处理的图片不超过物理内存的一半，几张超大图凑在一起也不会耗尽内存
+        budget=engine.default_memory_budget()
+        try:
+            if renditions:
+                batches=engine.export_renditions(paths,out_dir,renditions,workers=workers,ordered=False,
+                                                 cancel_event=cancel_event,memory_budget=budget)
+            else:
+                batches=([result] for result in engine.export_batch(paths,out_dir,settings,workers=workers,
+                                                                    ordered=False,manifest=manifest,
+                                                                    cancel_event=cancel_event,
+                                                                    memory_budget=budget))
+            done=0
+            # 多规格导出时一个源文件对应多个结果，进度按源文件计
+            for results in batches:
+                done+=1
+                encoded=""
+                for result in results:
+                    if result.error:
+                        summary["failed"].append(f"{os.path.basename(result.path)}：{result.error}")
+                    elif result.skipped:
+                        summary["skipped"]+=1
+                    else:
+                        summary["count"]+=1
+                        summary["out_path"]=result.out_path
+                        encoded=f"编码 {result.encode_s*1000:.0f} ms，{result.out_bytes/1e6:.2f} MB"
+                        summary["encoded"]=encoded
+                if any(result.error is None and not result.skipped for result in results):
+                    try:
+                        bytes_read+=os.path.getsize(results[0].path)
+                    except OSError:
+                        pass
+                elapsed=max(time.perf_counter()-start,1e-6)
+                self.export_queue.put(("progress",done,len(paths),os.path.basename(results[0].path),
+                                       summary["count"]/elapsed,bytes_read/elapsed/1e6,encoded))
+        except Exception as e:
+            summary["failed"].append(str(e))
+        summary["cancelled"]=cancel_event.is_set()
+        summary["orphans"]=manifest.orphans() if manifest else []
+        self.export_queue.put(("done",summary))
+
+    def poll_export_queue(self):
+        try:
+            while True:
+                msg=self.export_queue.get_nowait()
+                if msg[0]=="done":
+                    self.finish_export(msg[1])
+                    return
+                _,done,total,name,images_per_s,mb_per_s,encoded=msg
+                self.progress_bar.configure(value=done)
+                self.progress_label.configure(
+                    text=f"{done}/{total}  {name}  {encoded}  {images_per_s:.1f} 张/秒  {mb_per_s:.1f} MB/秒")
+        except queue.Empty:
+            pass
+        self.root.after(EXPORT_POLL_MS,self.poll_export_queue)
+
+    def cancel_export(self):
+        self.cancel_event.set()
+        self.cancel_button.configure(state=tk.DISABLED)
+        self.progress_label.configure(text="正在取消，等待当前文件完成…")
+
+    def finish_export(self,summary):
+        self.cancel_button.configure(state=tk.DISABLED)
+        count,skipped,failed,orphans=summary["count"],summary["skipped"],summary["failed"],summary["orphans"]
+        if summary["cancelled"]:
+            self.progress_label.configure(text=f"导出已取消，已完成 {count} 张")
+            messagebox.showinfo("导出取消",f"导出已取消，已完成 {count} 张图片，未写出不完整的文件。")
+            return
+        self.progress_label.configure(text=f"导出完成：{count} 张")
+        if count==1 and not skipped and not failed and summary["total"]==1:
+            messagebox.showinfo("导出成功",f"已导出：{summary['out_path']}\n{summary['encoded']}")
+            return
+        text=f"成功导出 {count} 张图片，未变化跳过 {skipped} 张"
+        if orphans:
+            text+=f"\n输出目录中有 {len(orphans)} 个孤立文件（源文件已不在本次导出中）：\n"+"\n".join(orphans[:10])
+        if failed:
+            messagebox.showwarning("导出完成",text+f"\n失败 {len(failed)} 张：\n"+"\n".join(failed[:10]))
+            return
+        messagebox.showinfo("导出完成",f"{text}\n输出目录：{summary['out_dir']}")
 
     # ===== 颜色选择 =====
     def choose_color(self):
         color_code=colorchooser.askcolor(title="选择水印颜色")
         if color_code:
             self.current_color=tuple(int(c) for c in color_code[0])
+            self.auto_color.set(False)
             self.update_preview()
 
     # ===== 模板管理 =====
@@ -384,17 +585,21 @@ class SimpleWatermarkApp:
             return
         tpl={
             "text":self.text_entry.get(),
-            "color":self.current_color,
+            "color":"auto" if self.auto_color.get() else self.current_color,
             "alpha":self.alpha_scale.get(),
             "font_size":self.font_size_var.get(),
-            "position":self.watermark_pos,
+            # 拖拽坐标优先，否则保存位置菜单中的锚点、auto 或 tile
+            "position":self.watermark_pos or self.position_var.get(),
+            "tile_spacing":self.tile_spacing_scale.get(),
+            "tile_angle":self.tile_angle_scale.get(),
             "shadow":self.shadow_enabled.get(),
             "outline":self.outline_enabled.get(),
             "scale_mode":self.scale_mode.get(),
             "scale_value":self.scale_value.get(),
             "prefix":self.prefix_entry.get(),
             "suffix":self.suffix_entry.get(),
-            "format":self.format_var.get()
+            "format":self.format_var.get(),
+            "encoder":self.encoder_var.get()
         }
         self.templates[name]=tpl
         self.templates["_last_used"]=name
@@ -408,12 +613,22 @@ class SimpleWatermarkApp:
             return
         self.text_entry.delete(0,tk.END)
         self.text_entry.insert(0,tpl["text"])
-        self.current_color=tuple(tpl["color"])
+        self.auto_color.set(tpl["color"]=="auto")
+        if tpl["color"]!="auto":
+            self.current_color=tuple(tpl["color"])
         self.alpha_scale.set(tpl["alpha"])
         self.font_size_var.set(tpl.get("font_size",5.0))
         self.font_size_entry.delete(0,tk.END)
         self.font_size_entry.insert(0,str(tpl.get("font_size",5.0)))
-        self.watermark_pos = tpl["position"]
+        position=tpl.get("position") or tpl.get("watermark_pos") or "center"
+        if isinstance(position,(list,tuple)):
+            self.watermark_pos=tuple(position)
+        else:
+            # 锚点、auto 和 tile 放进位置菜单，预览和批量导出都从菜单读取
+            self.watermark_pos=None
+            self.position_var.set(position if position in engine.POSITIONS else "center")
+        self.tile_spacing_scale.set(tpl.get("tile_spacing",engine.DEFAULT_SETTINGS["tile_spacing"]))
+        self.tile_angle_scale.set(tpl.get("tile_angle",engine.DEFAULT_SETTINGS["tile_angle"]))
         self.shadow_enabled.set(tpl.get("shadow",False))
         self.outline_enabled.set(tpl.get("outline",False))
         self.scale_mode.set(tpl.get("scale_mode","none"))
@@ -424,6 +639,7 @@ class SimpleWatermarkApp:
         self.suffix_entry.delete(0,tk.END)
         self.suffix_entry.insert(0,tpl.get("suffix","_watermarked"))
         self.format_var.set(tpl.get("format","PNG"))
+        self.encoder_var.set(tpl.get("encoder","default"))
         self.update_preview()
 
     def delete_template(self):
@@ -438,7 +654,8 @@ class SimpleWatermarkApp:
         menu=self.template_menu["menu"]
         menu.delete(0,tk.END)
         for name in self.templates.keys():
-            if name=="_last_used":
+            # 以下划线开头的是 _last_used、_encoder_profiles 等非模板条目
+            if name.startswith("_"):
                 continue
             menu.add_command(label=name,command=lambda v=name:self.select_template(v))
 
@@ -451,10 +668,105 @@ class SimpleWatermarkApp:
             json.dump(self.templates,f,ensure_ascii=False,indent=2)
 
     def load_templates(self):
-        if os.path.exists(TEMPLATE_FILE):
-            with open(TEMPLATE_FILE,"r",encoding="utf-8") as f:
-                return json.load(f)
-        return {}
+        return engine.load_templates(TEMPLATE_FILE)
+
+# ===== 虚拟列表 =====
+class VirtualList(tk.Frame):
+    """只绘制可见行的图片列表：条目可达几十万，插入和滚动的开销只与可见行数有关
+
+    每行显示文件名、大小和尺寸，尺寸只在行可见时从文件头读取并由 Catalog 缓存。
+    选中某行时调用 on_select(序号)。
+    """
+    ROW_HEIGHT = 20
+
+    def __init__(self, master, catalog, on_select, width=320):
+        super().__init__(master)
+        self.catalog = catalog
+        self.on_select = on_select
+        self.first = 0
+        self.selected = None
+        self.canvas = tk.Canvas(self, width=width, bg="white", highlightthickness=0, takefocus=1)
+        self.scrollbar = tk.Scrollbar(self, orient="vertical", command=self.yview)
+        self.canvas.pack(side=tk.LEFT, fill=tk.BOTH, expand=True)
+        self.scrollbar.pack(side=tk.LEFT, fill=tk.Y)
+        self.canvas.bind("<Configure>", lambda e: self.redraw())
+        self.canvas.bind("<Button-1>", self.click)
+        self.canvas.bind("<MouseWheel>", lambda e: self.scroll(-1 if e.delta > 0 else 1))
+        self.canvas.bind("<Button-4>", lambda e: self.scroll(-1))
+        self.canvas.bind("<Button-5>", lambda e: self.scroll(1))
+        self.canvas.bind("<Up>", lambda e: self.move(-1))
+        self.canvas.bind("<Down>", lambda e: self.move(1))
+
+    def visible_rows(self):
+        return max(1, self.canvas.winfo_height() // self.ROW_HEIGHT)
+
+    def refresh(self):
+        """条目数变化后调用，只重绘可见行"""
+        self.redraw()
+
+    def scroll(self, rows):
+        self.first = max(0, min(self.first + rows * 3, len(self.catalog) - self.visible_rows()))
+        self.redraw()
+
+    def yview(self, *args):
+        total, rows = len(self.catalog), self.visible_rows()
+        if args[0] == "moveto":
+            first = int(float(args[1]) * total)
+        elif args[2] == "pages":
+            first = self.first + int(args[1]) * rows
+        else:
+            first = self.first + int(args[1])
+        self.first = max(0, min(first, total - rows))
+        self.redraw()
+
+    def click(self, event):
+        self.canvas.focus_set()
+        index = self.first + event.y // self.ROW_HEIGHT
+        if index < len(self.catalog):
+            self.select(index)
+
+    def move(self, step):
+        index = 0 if self.selected is None else self.selected + step
+        self.select(max(0, min(index, len(self.catalog) - 1)))
+
+    def select(self, index):
+        if not 0 <= index < len(self.catalog):
+            return
+        self.selected = index
+        rows = self.visible_rows()
+        if index < self.first:
+            self.first = index
+        elif index >= self.first + rows:
+            self.first = index - rows + 1
+        self.redraw()
+        self.on_select(index)
+
+    def row_text(self, path):
+        text = os.path.basename(path)
+        sig = self.catalog.stat(path)
+        if sig is not None:
+            text += f"  {sig[0] / 1e6:.1f} MB"
+        size = self.catalog.dimensions(path)
+        if size is not None:
+            text += f"  {size[0]}×{size[1]}"
+        return text
+
+    def redraw(self):
+        total, rows = len(self.catalog), self.visible_rows()
+        self.first = max(0, min(self.first, total - rows))
+        width = self.canvas.winfo_width()
+        self.canvas.delete("all")
+        for row, index in enumerate(range(self.first, min(self.first + rows + 1, total))):
+            y = row * self.ROW_HEIGHT
+            if index == self.selected:
+                self.canvas.create_rectangle(0, y, width, y + self.ROW_HEIGHT, fill="#cce0ff", outline="")
+            self.canvas.create_text(4, y + self.ROW_HEIGHT // 2, text=self.row_text(self.catalog[index]),
+                                    anchor="w")
+        if total:
+            self.scrollbar.set(self.first / total, min(1.0, (self.first + rows) / total))
+        else:
+            self.scrollbar.set(0, 1)
+
 
 # ===== 简单输入框 =====
 def simple_input(prompt):
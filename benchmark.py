@@ -0,0 +1,259 @@
+import os
+import sys
+import json
+import time
+import argparse
+import platform
+import itertools
+import statistics
+import tempfile
+import multiprocessing
+from queue import Empty
+from PIL import Image, features
+import PIL
+
+import watermark_engine as engine
+import watermark_step1
+from instrument import StageTimer
+
+try:
+    import resource
+except ImportError:  # Windows 没有 resource 模块，峰值内存记为 None
+    resource = None
+
+SIZES_MP = [2, 12, 50, 200]
+MODES = ["RGB", "RGBA"]
+FORMATS = ["JPEG", "PNG", "TIFF"]
+EFFECTS = ["plain", "effects", "tile"]
+SCALES = ["none", "width", "height", "percent"]
+SCALE_VALUES = {"none": "0", "width": "1000", "height": "1000", "percent": "50"}
+EXTENSIONS = {"JPEG": ".jpg", "PNG": ".png", "TIFF": ".tiff"}
+RESULT_FILE = "benchmark_results.json"
+RESULT_POLL_S = 1.0  # 等待子进程结果时检查其是否还活着的间隔
+
+
+# ===== 合成测试图片 =====
+def synthetic_path(workdir, mp, mode, fmt):
+    return os.path.join(workdir, f"bench_{mp}mp_{mode}{EXTENSIONS[fmt]}")
+
+
+def make_synthetic(path, mp, mode, fmt):
+    """生成 3:2 的测试图：渐变加噪声，压缩难度接近真实照片；已存在则直接复用"""
+    if os.path.exists(path):
+        return
+    width = int((mp * 1_000_000 * 1.5) ** 0.5)
+    height = int(width / 1.5)
+    gradient = Image.linear_gradient("L").resize((width, height))
+    noise = Image.effect_noise((width, height), 24)
+    bands = [Image.blend(gradient, noise, 0.3), noise, gradient.transpose(Image.Transpose.FLIP_LEFT_RIGHT)]
+    if mode == "RGBA":
+        bands.append(gradient.transpose(Image.Transpose.FLIP_TOP_BOTTOM))
+    img = Image.merge(mode, bands)
+    tmp_path = path + ".part"
+    img.save(tmp_path, format=fmt, **({"quality": 90} if fmt == "JPEG" else {}))
+    os.replace(tmp_path, path)
+
+
+# ===== 单个用例 =====
+def case_id(case):
+    return "{kind}-{mp}mp-{mode}-{fmt}-{effects}-{scale}".format(**case)
+
+
+def build_cases(args):
+    cases = []
+    for mp, mode, fmt, effects, scale in itertools.product(args.sizes, args.modes, args.formats,
+                                                           args.effects, args.scales):
+        if fmt == "JPEG" and mode == "RGBA":
+            continue
+        cases.append({"kind": "engine", "mp": mp, "mode": mode, "fmt": fmt, "effects": effects, "scale": scale})
+    if args.step1:
+        # watermark_step1 只处理 RGB 的 JPEG/PNG，也不支持缩放和特效
+        for mp, fmt in itertools.product(args.sizes, [f for f in args.formats if f != "TIFF"]):
+            cases.append({"kind": "step1", "mp": mp, "mode": "RGB", "fmt": fmt, "effects": "plain",
+                          "scale": "none"})
+    return cases
+
+
+def _peak_rss_mb():
+    # Linux 上 ru_maxrss 会把 exec 之前父进程的内存也算进来，优先读取本进程的 VmHWM
+    try:
+        with open("/proc/self/status", "r") as f:
+            for line in f:
+                if line.startswith("VmHWM:"):
+                    return round(int(line.split()[1]) / 1024, 1)
+    except OSError:
+        pass
+    if resource is None:
+        return None
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # Linux 单位是 KB，macOS 是字节
+    return round(peak / (1024 * 1024 if sys.platform == "darwin" else 1024), 1)
+
+
+def _timed(func, *args, **kwargs):
+    start = time.perf_counter()
+    result = func(*args, **kwargs)
+    return result, time.perf_counter() - start
+
+
+def run_case(case, src, out_dir, repeat, out_format, backend="pil", encoder="default"):
+    """在当前进程内跑一个用例 repeat 次，返回各阶段耗时的中位数"""
+    settings = engine.normalize_settings(text="示例水印 2025-09-21",
+                                         shadow=case["effects"] == "effects",
+                                         outline=case["effects"] == "effects",
+                                         position="tile" if case["effects"] == "tile" else None,
+                                         scale_mode=case["scale"],
+                                         scale_value=SCALE_VALUES[case["scale"]],
+                                         format=out_format,
+                                         backend=backend,
+                                         encoder=encoder)
+    settings["suffix"] = "_" + case_id(case)
+    out_path = engine.output_path_for(src, out_dir, settings)
+    samples = {}
+    for _ in range(repeat):
+        if case["kind"] == "step1":
+            _, elapsed = _timed(watermark_step1.add_watermark, src, out_path, "2025-09-21", 100,
+                                "#FF0000", "right-bottom")
+            stages = {"add_watermark": elapsed}
+        else:
+            # 与 --trace 使用同一套阶段计时：open/decode/convert/resize/font/text/composite/encode
+            timer = StageTimer(src)
+            engine.process_file(src, out_dir, settings, timer)
+            stages = timer.stages
+        for name, value in stages.items():
+            samples.setdefault(name, []).append(value)
+    stages = {name: statistics.median(values) for name, values in samples.items()}
+    total = sum(stages.values())
+    return {
+        "id": case_id(case),
+        **case,
+        "stages": {name: round(value, 5) for name, value in stages.items()},
+        "total": round(total, 5),
+        "images_per_s": round(1 / total, 3) if total else None,
+        "output_bytes": os.path.getsize(out_path),
+        "peak_rss_mb": _peak_rss_mb(),
+    }
+
+
+def _case_worker(case, src, out_dir, repeat, out_format, backend, encoder, queue):
+    try:
+        queue.put(run_case(case, src, out_dir, repeat, out_format, backend, encoder))
+    except Exception as e:
+        queue.put({"id": case_id(case), **case, "error": f"{type(e).__name__}: {e}"})
+
+
+def run_isolated(case, src, out_dir, repeat, out_format, backend="pil", encoder="default"):
+    """每个用例在新进程中运行，峰值内存互不干扰
+
+    子进程没有给出结果就退出（如大尺寸用例被 OOM killer 杀掉）时记为错误，不会一直等待。
+    """
+    ctx = multiprocessing.get_context("spawn")
+    queue = ctx.Queue()
+    proc = ctx.Process(target=_case_worker, args=(case, src, out_dir, repeat, out_format, backend, encoder, queue))
+    proc.start()
+    while True:
+        try:
+            result = queue.get(timeout=RESULT_POLL_S)
+            break
+        except Empty:
+            if not proc.is_alive():
+                # 子进程退出前放进队列的结果可能还在管道里，最后再取一次
+                try:
+                    result = queue.get(timeout=RESULT_POLL_S)
+                except Empty:
+                    result = {"id": case_id(case), **case, "error": f"子进程异常退出（exitcode {proc.exitcode}）"}
+                break
+    proc.join()
+    return result
+
+
+# ===== 与基线比较 =====
+def compare_with_baseline(results, baseline_path, threshold):
+    """逐个用例比较总耗时，返回变慢超过 threshold 比例的用例 id 列表"""
+    with open(baseline_path, "r", encoding="utf-8") as f:
+        baseline = {r["id"]: r for r in json.load(f)["results"] if "total" in r}
+    regressions = []
+    print(f"\n与基线 {baseline_path} 比较（阈值 {threshold:.0%}）：")
+    for r in results:
+        base = baseline.get(r["id"])
+        if base is None or "total" not in r:
+            continue
+        ratio = r["total"] / base["total"] if base["total"] else 1.0
+        flag = ""
+        if ratio > 1 + threshold:
+            flag = "  ⚠️ 变慢"
+            regressions.append(r["id"])
+        elif ratio < 1 - threshold:
+            flag = "  ✅ 变快"
+        print(f"  {r['id']:<44} {base['total']:>8.3f}s -> {r['total']:>8.3f}s  x{ratio:.2f}{flag}")
+    return regressions
+
+
+def environment_info(backend, encoder):
+    return {
+        "backend": backend,
+        "encoder": encoder,
+        "timestamp": time.strftime("%Y-%m-%dT%H:%M:%S"),
+        "python": platform.python_version(),
+        "pillow": PIL.__version__,
+        "libjpeg_turbo": features.check_feature("libjpeg_turbo"),
+        "platform": platform.platform(),
+        "cpu_count": os.cpu_count(),
+    }
+
+
+# ===== 命令行入口 =====
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="渲染流程基准测试：按尺寸、模式、格式、特效和缩放方式组合计时")
+    parser.add_argument("--sizes", type=int, nargs="+", default=SIZES_MP, help="图片像素数（百万），默认 2 12 50 200")
+    parser.add_argument("--modes", nargs="+", choices=MODES, default=MODES)
+    parser.add_argument("--formats", nargs="+", choices=FORMATS, default=FORMATS, help="输入图片格式")
+    parser.add_argument("--effects", nargs="+", choices=EFFECTS, default=EFFECTS[:2],
+                        help="plain 无特效，effects 阴影+描边，tile 斜向平铺（默认不测）")
+    parser.add_argument("--scales", nargs="+", choices=SCALES, default=SCALES)
+    parser.add_argument("--out-format", choices=engine.OUTPUT_FORMATS, default="JPEG", help="导出格式")
+    parser.add_argument("--encoder", choices=list(engine.ENCODER_PROFILES), default="default", help="编码档位")
+    parser.add_argument("--backend", choices=["pil", "numpy"], default="pil",
+                        help="水印合成后端；用例 id 不含后端，可用 --baseline 比较两种后端")
+    parser.add_argument("--no-step1", dest="step1", action="store_false", help="不测 watermark_step1.add_watermark")
+    parser.add_argument("--repeat", type=int, default=3, help="每个用例重复次数，取中位数")
+    parser.add_argument("--workdir", default=os.path.join(tempfile.gettempdir(), "watermark_bench"),
+                        help="存放合成图片和输出的目录")
+    parser.add_argument("-o", "--output", default=RESULT_FILE, help="结果 JSON 文件")
+    parser.add_argument("--baseline", help="基线结果 JSON，用于比较")
+    parser.add_argument("--threshold", type=float, default=0.10, help="判定变慢的比例，默认 0.10")
+    args = parser.parse_args(argv)
+
+    engine.find_font_path()
+    out_dir = os.path.join(args.workdir, "out")
+    os.makedirs(out_dir, exist_ok=True)
+
+    results = []
+    print(f"{'用例':<44} {'总耗时':>9} {'张/秒':>8} {'峰值内存':>9}  各阶段")
+    for case in build_cases(args):
+        src = synthetic_path(args.workdir, case["mp"], case["mode"], case["fmt"])
+        make_synthetic(src, case["mp"], case["mode"], case["fmt"])
+        result = run_isolated(case, src, out_dir, args.repeat, args.out_format, args.backend,
+                              args.encoder)
+        results.append(result)
+        if "error" in result:
+            print(f"{result['id']:<44} ❌ {result['error']}")
+            continue
+        stages = "  ".join(f"{k}={v * 1000:.0f}ms" for k, v in result["stages"].items())
+        rss = f"{result['peak_rss_mb']:.0f}MB" if result["peak_rss_mb"] is not None else "-"
+        print(f"{result['id']:<44} {result['total']:>8.3f}s {result['images_per_s']:>8.2f} {rss:>9}  {stages}")
+
+    with open(args.output, "w", encoding="utf-8") as f:
+        json.dump({"environment": environment_info(args.backend, args.encoder), "results": results}, f, ensure_ascii=False, indent=2)
+    print(f"\n结果已保存到 {args.output}")
+
+    if args.baseline:
+        regressions = compare_with_baseline(results, args.baseline, args.threshold)
+        if regressions:
+            print(f"❌ {len(regressions)} 个用例比基线变慢")
+            return 1
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,125 @@
+import os
+
+from watermark_engine import SUPPORTED_FORMATS, read_header
+
+SCAN_BATCH_SIZE = 500
+
+
+def is_image_name(name):
+    return os.path.splitext(name)[1].lower() in SUPPORTED_FORMATS
+
+
+# ===== 目录扫描 =====
+def scan_images(root, recursive=True):
+    """用 os.scandir 逐个产出 (路径, stat)，不必等整个目录树扫描完
+
+    stat 直接取自目录项，大多数系统上不需要额外的系统调用。
+    同一文件夹中的文件按名称排序；不进入隐藏文件夹，也不跟随指向文件夹的符号链接，避免循环。
+    """
+    stack = [root]
+    while stack:
+        folder = stack.pop()
+        try:
+            it = os.scandir(folder)
+        except OSError:
+            continue
+        files, subdirs = [], []
+        with it:
+            for entry in it:
+                try:
+                    if entry.is_dir(follow_symlinks=False):
+                        if recursive and not entry.name.startswith("."):
+                            subdirs.append(entry.path)
+                    elif is_image_name(entry.name) and entry.is_file():
+                        files.append((entry.path, entry.stat()))
+                except OSError:
+                    continue
+        files.sort()
+        yield from files
+        # 倒序压栈，子文件夹按名称顺序展开
+        stack.extend(sorted(subdirs, reverse=True))
+
+
+def scan_batches(root, recursive=True, batch_size=SCAN_BATCH_SIZE):
+    """把 scan_images 的结果按 batch_size 分批产出，便于界面分批显示"""
+    batch = []
+    for item in scan_images(root, recursive):
+        batch.append(item)
+        if len(batch) >= batch_size:
+            yield batch
+            batch = []
+    if batch:
+        yield batch
+
+
+def read_dimensions(path):
+    """只解析文件头得到图像宽高，不解码像素也不数帧；无法识别时返回 None
+
+    列表在主线程中为每个可见行调用，数 GIF 的帧要扫描整个文件，滚动时会卡顿。
+    """
+    header = read_header(path, count_frames=False)
+    return header[0] if header else None
+
+
+# ===== 图片目录 =====
+class Catalog:
+    """按加入顺序保存的图片路径表
+
+    用字典记录已加入的路径，去重是 O(1)；文件大小、修改时间和图像尺寸在第一次用到时读取，
+    之后一直使用缓存的值，导入后再改动的文件在列表中仍显示导入时的信息。
+    """
+
+    def __init__(self):
+        self.paths = []
+        self._index = {}
+        self._stat = {}
+        self._dims = {}
+
+    def __len__(self):
+        return len(self.paths)
+
+    def __getitem__(self, index):
+        return self.paths[index]
+
+    def __iter__(self):
+        return iter(self.paths)
+
+    @staticmethod
+    def _key(path):
+        return os.path.normcase(os.path.abspath(path))
+
+    def add(self, path, st=None):
+        """加入一张图片，已存在时返回 False；st 为扫描时已经拿到的 stat 结果"""
+        key = self._key(path)
+        if key in self._index:
+            return False
+        self._index[key] = len(self.paths)
+        self.paths.append(path)
+        if st is not None:
+            self._stat[path] = (st.st_size, st.st_mtime_ns)
+        return True
+
+    def extend(self, items):
+        """批量加入路径或 (路径, stat)，返回新加入的数量"""
+        added = 0
+        for item in items:
+            path, st = item if isinstance(item, tuple) else (item, None)
+            added += self.add(path, st)
+        return added
+
+    def stat(self, path):
+        """返回 (文件大小, 修改时间)，文件不存在时返回 None"""
+        sig = self._stat.get(path)
+        if sig is None:
+            try:
+                st = os.stat(path)
+            except OSError:
+                return None
+            sig = self._stat[path] = (st.st_size, st.st_mtime_ns)
+        return sig
+
+    def dimensions(self, path):
+        """返回图像宽高并缓存，只读取文件头；无法识别时返回 None"""
+        if path not in self._dims:
+            self._dims[path] = read_dimensions(path)
+        return self._dims[path]
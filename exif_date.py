@@ -0,0 +1,172 @@
+import os
+import json
+import struct
+from concurrent.futures import ThreadPoolExecutor
+
+CACHE_FILE = ".exif_date_cache.json"
+TAG_EXIF_IFD = 0x8769
+TAG_DATETIME_ORIGINAL = 0x9003
+TYPE_ASCII = 2
+
+
+# ===== EXIF 段读取 =====
+def _read_jpeg_app1(f):
+    """从 JPEG 文件头开始逐段跳过，只读出 Exif APP1 段的 TIFF 数据"""
+    if f.read(2) != b"\xff\xd8":
+        return None
+    while True:
+        header = f.read(4)
+        if len(header) < 4 or header[0] != 0xFF:
+            return None
+        marker = header[1]
+        length = struct.unpack(">H", header[2:])[0]
+        # SOS 之后是压缩数据，EXIF 一定在它之前
+        if marker == 0xDA or length < 2:
+            return None
+        if marker == 0xE1:
+            data = f.read(length - 2)
+            if data.startswith(b"Exif\x00\x00"):
+                return data[6:]
+        else:
+            f.seek(length - 2, os.SEEK_CUR)
+
+
+def _read_png_exif(f):
+    """遍历 PNG 数据块，读出 eXIf 块；遇到图像数据块即停止"""
+    if f.read(8) != b"\x89PNG\r\n\x1a\n":
+        return None
+    while True:
+        header = f.read(8)
+        if len(header) < 8:
+            return None
+        length, chunk_type = struct.unpack(">I4s", header)
+        if chunk_type == b"eXIf":
+            return f.read(length)
+        if chunk_type in (b"IDAT", b"IEND"):
+            return None
+        f.seek(length + 4, os.SEEK_CUR)
+
+
+def read_exif_block(path):
+    """只读取文件头部的 EXIF 原始数据（TIFF 结构），不解码图像"""
+    with open(path, "rb") as f:
+        head = f.read(2)
+        f.seek(0)
+        if head == b"\xff\xd8":
+            return _read_jpeg_app1(f)
+        if head == b"\x89P":
+            return _read_png_exif(f)
+    return None
+
+
+def _ifd_entries(tiff, offset, endian):
+    count = struct.unpack_from(endian + "H", tiff, offset)[0]
+    for i in range(count):
+        yield struct.unpack_from(endian + "HHII", tiff, offset + 2 + i * 12)
+
+
+def parse_datetime_original(tiff):
+    """在 TIFF 结构中找到 DateTimeOriginal，返回 "YYYY-MM-DD"，没有则返回 None"""
+    if tiff[:2] == b"II":
+        endian = "<"
+    elif tiff[:2] == b"MM":
+        endian = ">"
+    else:
+        return None
+    ifd0 = struct.unpack_from(endian + "I", tiff, 4)[0]
+    # 拍摄日期在 Exif 子目录中，个别相机写在 IFD0，两处都查
+    offsets = [ifd0]
+    for tag, _type, _count, value in _ifd_entries(tiff, ifd0, endian):
+        if tag == TAG_EXIF_IFD:
+            offsets.insert(0, value)
+    for offset in offsets:
+        for tag, type_, count, value in _ifd_entries(tiff, offset, endian):
+            if tag != TAG_DATETIME_ORIGINAL or type_ != TYPE_ASCII or count < 19:
+                continue
+            raw = tiff[value:value + 19].decode("ascii", "replace")
+            return _format_date(raw)
+    return None
+
+
+def _format_date(raw):
+    """把 "YYYY:MM:DD HH:MM:SS" 转成 "YYYY-MM-DD"，格式不对时返回 None"""
+    date = raw[:10].split(":")
+    if len(date) != 3 or not all(part.isdigit() for part in date):
+        return None
+    year, month, day = date
+    if not (1 <= int(month) <= 12 and 1 <= int(day) <= 31):
+        return None
+    return f"{year}-{month}-{day}"
+
+
+def get_exif_date(path):
+    """读取拍摄日期（年月日），读取或解析失败时返回 None"""
+    try:
+        tiff = read_exif_block(path)
+        return parse_datetime_original(tiff) if tiff else None
+    except (OSError, struct.error):
+        return None
+
+
+# ===== 持久化缓存 =====
+class ExifDateCache:
+    """以 (路径, 文件大小, 修改时间) 为键缓存拍摄日期，保存为 JSON 文件"""
+
+    def __init__(self, cache_path):
+        self.cache_path = cache_path
+        self.entries = {}
+        self.dirty = False
+        if cache_path and os.path.exists(cache_path):
+            try:
+                with open(cache_path, "r", encoding="utf-8") as f:
+                    self.entries = json.load(f)
+            except (OSError, ValueError):
+                self.entries = {}
+
+    def get(self, path, st):
+        entry = self.entries.get(path)
+        if entry and entry[0] == st.st_size and entry[1] == st.st_mtime_ns:
+            return True, entry[2]
+        return False, None
+
+    def put(self, path, st, date):
+        self.entries[path] = [st.st_size, st.st_mtime_ns, date]
+        self.dirty = True
+
+    def save(self):
+        if not self.cache_path or not self.dirty:
+            return
+        tmp_path = self.cache_path + ".tmp"
+        with open(tmp_path, "w", encoding="utf-8") as f:
+            json.dump(self.entries, f, ensure_ascii=False)
+        os.replace(tmp_path, self.cache_path)
+        self.dirty = False
+
+
+# ===== 并发扫描 =====
+def scan_dates(paths, cache_path=None, workers=None):
+    """用线程池并发读取多张图片的拍摄日期，返回 {路径: 日期或 None}
+
+    命中缓存（大小和修改时间都未变）的文件不会再打开。
+    """
+    cache = ExifDateCache(cache_path)
+
+    def lookup(path):
+        key = os.path.abspath(path)
+        try:
+            st = os.stat(path)
+        except OSError:
+            return path, key, None, None
+        hit, date = cache.get(key, st)
+        if hit:
+            return path, key, None, date
+        return path, key, st, get_exif_date(path)
+
+    results = {}
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        for path, key, st, date in executor.map(lookup, paths):
+            if st is not None:
+                cache.put(key, st, date)
+            results[path] = date
+    cache.save()
+    return results
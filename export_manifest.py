@@ -0,0 +1,81 @@
+import os
+import json
+import hashlib
+
+MANIFEST_FILE = ".watermark_manifest.json"
+MANIFEST_VERSION = 1
+# 只影响输出文件名、不影响图像内容的设置不参与设置哈希
+NAME_ONLY_KEYS = ("prefix", "suffix")
+# 合成后端只影响速度，pil 与 numpy 的输出逐像素一致；界面装有 numpy 时自动用 numpy，命令行默认 pil，
+# 计入哈希的话两边交替导出同一文件夹时每次都会全部重新渲染
+IGNORED_KEYS = NAME_ONLY_KEYS + ("backend",)
+
+
+def settings_digest(settings):
+    """对影响输出内容的有效设置（文字、颜色、透明度、字号、位置、特效、缩放、格式等）求哈希，不含合成后端"""
+    effective = {k: v for k, v in settings.items() if k not in IGNORED_KEYS}
+    data = json.dumps(effective, sort_keys=True, ensure_ascii=False, default=list)
+    return hashlib.sha1(data.encode("utf-8")).hexdigest()
+
+
+def source_fingerprint(path, content_hash=False):
+    """源文件指纹：默认取大小和修改时间；content_hash 时取大小和 SHA-256，不受 touch 影响"""
+    st = os.stat(path)
+    if not content_hash:
+        return {"size": st.st_size, "mtime_ns": st.st_mtime_ns}
+    digest = hashlib.sha256()
+    with open(path, "rb") as f:
+        for chunk in iter(lambda: f.read(1 << 20), b""):
+            digest.update(chunk)
+    return {"size": st.st_size, "sha256": digest.hexdigest()}
+
+
+class ExportManifest:
+    """导出目录中的清单：记录每个输出文件对应的源文件指纹和设置哈希
+
+    再次导出时，指纹和设置都没变且输出文件仍在的条目可以直接跳过；
+    本次导出没有涉及的旧条目即为孤立输出（源文件已删除或改名）。
+    """
+
+    def __init__(self, out_dir):
+        self.path = os.path.join(out_dir, MANIFEST_FILE)
+        self.out_dir = out_dir
+        self.entries = {}
+        self.seen = set()
+        if os.path.exists(self.path):
+            try:
+                with open(self.path, "r", encoding="utf-8") as f:
+                    data = json.load(f)
+                if data.get("version") == MANIFEST_VERSION:
+                    self.entries = data.get("entries", {})
+            except (OSError, ValueError):
+                self.entries = {}
+
+    def is_current(self, out_name, source, fingerprint, digest):
+        """输出文件存在且源文件指纹、设置哈希都与上次一致时返回 True"""
+        self.seen.add(out_name)
+        entry = self.entries.get(out_name)
+        return (entry is not None
+                and entry["source"] == os.path.abspath(source)
+                and entry["fingerprint"] == fingerprint
+                and entry["settings"] == digest
+                and os.path.exists(os.path.join(self.out_dir, out_name)))
+
+    def record(self, out_name, source, fingerprint, digest):
+        self.seen.add(out_name)
+        self.entries[out_name] = {
+            "source": os.path.abspath(source),
+            "fingerprint": fingerprint,
+            "settings": digest,
+        }
+
+    def orphans(self):
+        """本次导出没有涉及的输出文件名（清单中仍有记录且文件仍存在）"""
+        return sorted(name for name in self.entries
+                      if name not in self.seen and os.path.exists(os.path.join(self.out_dir, name)))
+
+    def save(self):
+        tmp_path = self.path + ".tmp"
+        with open(tmp_path, "w", encoding="utf-8") as f:
+            json.dump({"version": MANIFEST_VERSION, "entries": self.entries}, f, ensure_ascii=False, indent=1)
+        os.replace(tmp_path, self.path)
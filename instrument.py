@@ -0,0 +1,135 @@
+import json
+import math
+import time
+import cProfile
+import pstats
+import tracemalloc
+from contextlib import contextmanager, nullcontext
+
+# 导出流程中的阶段，按执行顺序排列，汇总表也按这个顺序输出
+STAGES = ["open", "decode", "convert", "resize", "font", "placement", "text", "composite", "encode"]
+
+
+class StageTimer:
+    """记录单张图片各阶段的耗时，以及读写字节数、像素数等计数"""
+
+    def __init__(self, path):
+        self.path = path
+        self.stages = {}
+        self.counters = {}
+
+    @contextmanager
+    def stage(self, name):
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.stages[name] = self.stages.get(name, 0.0) + time.perf_counter() - start
+
+    def add(self, name, seconds):
+        """直接累加某阶段的耗时，用于无法用 with 包住的阶段（如边生成边编码的多帧图像）"""
+        self.stages[name] = self.stages.get(name, 0.0) + seconds
+
+    def count(self, **values):
+        self.counters.update(values)
+
+    def to_dict(self):
+        return {"path": self.path, "stages": self.stages, **self.counters}
+
+
+class NullTimer:
+    """未开启统计时使用的空计时器，不产生任何开销"""
+
+    def stage(self, name):
+        return nullcontext()
+
+    def add(self, name, seconds):
+        pass
+
+    def count(self, **values):
+        pass
+
+
+NULL_TIMER = NullTimer()
+
+
+# ===== 输出与汇总 =====
+class TraceWriter:
+    """把每张图片的统计写成一行 JSON（JSON Lines），并保留下来用于汇总"""
+
+    def __init__(self, path):
+        self.f = open(path, "w", encoding="utf-8")
+        self.records = []
+
+    def write(self, record):
+        self.records.append(record)
+        self.f.write(json.dumps(record, ensure_ascii=False) + "\n")
+        self.f.flush()
+
+    def close(self):
+        self.f.close()
+
+
+def percentile(sorted_values, q):
+    """最近秩法求分位数，sorted_values 须已排序"""
+    if not sorted_values:
+        return 0.0
+    index = max(0, math.ceil(q * len(sorted_values)) - 1)
+    return sorted_values[index]
+
+
+def summarize(records):
+    """按阶段汇总 p50/p95/max/总耗时，以及读写字节和像素总数"""
+    per_stage = {}
+    for record in records:
+        for name, value in record["stages"].items():
+            per_stage.setdefault(name, []).append(value)
+    order = STAGES + sorted(set(per_stage) - set(STAGES))
+    summary = {"images": len(records), "stages": {}}
+    for name in order:
+        values = sorted(per_stage.get(name, []))
+        if values:
+            summary["stages"][name] = {
+                "p50": percentile(values, 0.50),
+                "p95": percentile(values, 0.95),
+                "max": values[-1],
+                "total": sum(values),
+            }
+    for key in ("bytes_read", "bytes_written", "source_pixels", "output_pixels"):
+        summary[key] = sum(record.get(key, 0) for record in records)
+    return summary
+
+
+def format_summary(summary):
+    lines = [f"共统计 {summary['images']} 张图片，读取 {summary['bytes_read'] / 1e6:.1f} MB，"
+             f"写出 {summary['bytes_written'] / 1e6:.1f} MB，"
+             f"源像素 {summary['source_pixels'] / 1e6:.1f} MP，输出像素 {summary['output_pixels'] / 1e6:.1f} MP",
+             f"{'阶段':<10}{'p50(ms)':>10}{'p95(ms)':>10}{'max(ms)':>10}{'合计(s)':>10}"]
+    for name, s in summary["stages"].items():
+        lines.append(f"{name:<12}{s['p50'] * 1000:>10.1f}{s['p95'] * 1000:>10.1f}"
+                     f"{s['max'] * 1000:>10.1f}{s['total']:>10.2f}")
+    return "\n".join(lines)
+
+
+# ===== 单张图片剖析 =====
+def profile_call(func, *args, prof_path=None, top=25, **kwargs):
+    """用 cProfile 和 tracemalloc 运行一次 func，打印最耗时的函数和 Python 内存分配峰值
+
+    注意 tracemalloc 只统计 Python 层的分配，Pillow 图像缓冲区由 C 代码分配，不在其中。
+    """
+    profiler = cProfile.Profile()
+    tracemalloc.start()
+    try:
+        result = profiler.runcall(func, *args, **kwargs)
+        snapshot = tracemalloc.take_snapshot()
+        _, peak = tracemalloc.get_traced_memory()
+    finally:
+        tracemalloc.stop()
+    if prof_path:
+        profiler.dump_stats(prof_path)
+        print(f"cProfile 结果已保存到 {prof_path}（可用 snakeviz 或 pstats 查看）")
+    pstats.Stats(profiler).sort_stats("cumulative").print_stats(top)
+    print(f"Python 内存分配峰值：{peak / 1e6:.1f} MB，分配最多的位置：")
+    for stat in snapshot.statistics("lineno")[:10]:
+        print(f"  {stat}")
+    return result
@@ -0,0 +1,55 @@
+from collections import OrderedDict
+from PIL import Image
+
+try:
+    import numpy as np
+except ImportError:  # numpy 是可选依赖，未安装时只能使用 Pillow 合成
+    np = None
+
+PREMULTIPLIED_CACHE_SIZE = 32
+_premultiplied_cache = OrderedDict()
+
+
+def available():
+    return np is not None
+
+
+def premultiplied(sprite):
+    """把 RGBA 贴图拆成预乘颜色 color*alpha 和 255-alpha 两个数组
+
+    批量导出时同一贴图会被多张图片反复使用，按贴图对象缓存，只计算一次。
+    """
+    key = id(sprite)
+    cached = _premultiplied_cache.get(key)
+    if cached is not None and cached[0] is sprite:
+        _premultiplied_cache.move_to_end(key)
+        return cached[1:]
+    rgba = np.asarray(sprite, dtype=np.uint32)
+    alpha = rgba[..., 3:]
+    result = (rgba[..., :3] * alpha, 255 - alpha)
+    # 缓存里保留贴图本身，避免贴图被回收后 id 被复用
+    _premultiplied_cache[key] = (sprite,) + result
+    if len(_premultiplied_cache) > PREMULTIPLIED_CACHE_SIZE:
+        _premultiplied_cache.popitem(last=False)
+    return result
+
+
+def blend_sprite_rgb(img, sprite, dest):
+    """把贴图就地混合到 RGB 图像的 dest 处，只读写贴图覆盖的行和列
+
+    整数运算与 Pillow 的 alpha_composite 在目标不透明时完全一致，输出逐像素相同，
+    但不需要先把整幅图像转成 RGBA。
+    """
+    x, y = dest
+    left, top = max(x, 0), max(y, 0)
+    right, bottom = min(x + sprite.width, img.width), min(y + sprite.height, img.height)
+    if left >= right or top >= bottom:
+        return img
+    color, inv_alpha = premultiplied(sprite)
+    source = np.s_[top - y:bottom - y, left - x:right - x]
+    region = np.asarray(img.crop((left, top, right, bottom)), dtype=np.uint32)
+    # Pillow 的定点算法：out = (X*128 + 128*128) / 255 >> 7，其中 X = src*a + dst*(255-a)
+    blended = (color[source] + region * inv_alpha[source]) * 128 + 128 * 128
+    blended = (((blended >> 8) + blended) >> 8) >> 7
+    img.paste(Image.fromarray(blended.astype(np.uint8)), (left, top))
+    return img
@@ -0,0 +1,212 @@
+import os
+import hashlib
+import threading
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+from PIL import Image
+
+import watermark_engine as engine
+
+CACHE_VERSION = 1
+SAMPLE_BYTES = 64 * 1024
+DEFAULT_CACHE_BYTES = 256 * 1024 * 1024
+MEMORY_ITEMS = 32
+PREFETCH_RADIUS = 3
+JPEG_QUALITY = 90
+
+
+def default_cache_dir():
+    base = os.environ.get("XDG_CACHE_HOME") or os.path.join(os.path.expanduser("~"), ".cache")
+    return os.path.join(base, "watermark_thumbnails")
+
+
+def content_key(path, max_size):
+    """按文件内容计算缩略图的键：文件大小加首尾各 64 KB 的哈希
+
+    只读取两小块数据，十几万张图也很快；文件被改写后键随之变化，
+    文件改名或移动后仍能命中原来的缩略图。
+    """
+    digest = hashlib.sha1(f"{CACHE_VERSION}:{max_size[0]}x{max_size[1]}".encode("ascii"))
+    with open(path, "rb") as f:
+        size = os.fstat(f.fileno()).st_size
+        digest.update(str(size).encode("ascii"))
+        digest.update(f.read(SAMPLE_BYTES))
+        if size > 2 * SAMPLE_BYTES:
+            f.seek(-SAMPLE_BYTES, os.SEEK_END)
+            digest.update(f.read(SAMPLE_BYTES))
+    return digest.hexdigest()
+
+
+# ===== 磁盘缓存 =====
+class ThumbnailCache:
+    """磁盘上的缩略图缓存，总大小超过 max_bytes 时按最近使用时间淘汰
+
+    文件名为 "键.宽x高.jpg/png"，原图尺寸记在文件名里，读取时不必再打开原图。
+    不透明的缩略图存为 JPEG，有透明通道的存为 PNG。
+    使用顺序用文件修改时间保存，重新启动后仍然有效。
+    """
+
+    def __init__(self, cache_dir=None, max_bytes=DEFAULT_CACHE_BYTES):
+        self.cache_dir = cache_dir or default_cache_dir()
+        self.max_bytes = max_bytes
+        self.lock = threading.Lock()
+        self.entries = OrderedDict()
+        self.total = 0
+        os.makedirs(self.cache_dir, exist_ok=True)
+        found = []
+        with os.scandir(self.cache_dir) as it:
+            for entry in it:
+                parts = entry.name.split(".")
+                if len(parts) != 3 or not entry.is_file():
+                    continue
+                st = entry.stat()
+                found.append((st.st_mtime_ns, parts[0], entry.name, st.st_size))
+        for _mtime, key, name, size in sorted(found):
+            self.entries[key] = (name, size)
+            self.total += size
+
+    def get(self, key):
+        """返回 (缩略图, 原图尺寸)，未命中时返回 None"""
+        with self.lock:
+            item = self.entries.get(key)
+            if item is None:
+                return None
+            self.entries.move_to_end(key)
+        name = item[0]
+        path = os.path.join(self.cache_dir, name)
+        try:
+            with Image.open(path) as im:
+                im.load()
+            os.utime(path)
+        except OSError:
+            self._discard(key)
+            return None
+        width, height = name.split(".")[1].split("x")
+        return im, (int(width), int(height))
+
+    def put(self, key, img, full_size):
+        fmt, ext, options = (("PNG", "png", {"compress_level": 1}) if img.mode == "RGBA"
+                             else ("JPEG", "jpg", {"quality": JPEG_QUALITY}))
+        name = f"{key}.{full_size[0]}x{full_size[1]}.{ext}"
+        path = os.path.join(self.cache_dir, name)
+        tmp_path = f"{path}.{threading.get_ident()}.part"
+        try:
+            img.save(tmp_path, format=fmt, **options)
+            os.replace(tmp_path, path)
+            size = os.path.getsize(path)
+        except OSError:
+            # 缓存写不进去不影响预览，下次重新生成
+            if os.path.exists(tmp_path):
+                os.remove(tmp_path)
+            return
+        with self.lock:
+            old = self.entries.pop(key, None)
+            if old is not None:
+                self.total -= old[1]
+            self.entries[key] = (name, size)
+            self.total += size
+            evicted = []
+            while self.total > self.max_bytes and len(self.entries) > 1:
+                _key, (old_name, old_size) = self.entries.popitem(last=False)
+                self.total -= old_size
+                evicted.append(old_name)
+        for old_name in evicted:
+            try:
+                os.remove(os.path.join(self.cache_dir, old_name))
+            except OSError:
+                pass
+
+    def _discard(self, key):
+        with self.lock:
+            item = self.entries.pop(key, None)
+            if item is not None:
+                self.total -= item[1]
+
+
+# ===== 后台生成 =====
+class ThumbnailService:
+    """在线程池中生成预览代理图，依次查内存、磁盘缓存，都未命中才解码原图
+
+    JPEG 通过 draft 缩小解码；Pillow 解码时会释放 GIL，线程池可以并行。
+    request 返回 Future，结果为 (代理图, 原图尺寸)；prefetch 为相邻条目提前生成，
+    选中位置移动后尚未开始的旧预取任务会被取消。
+    """
+
+    def __init__(self, max_size, native=False, cache=None, workers=None, memory_items=MEMORY_ITEMS):
+        self.max_size = max_size
+        self.native = native
+        self.cache = cache
+        self.pool = ThreadPoolExecutor(max_workers=workers or min(4, os.cpu_count() or 1),
+                                       thread_name_prefix="thumbnail")
+        self.lock = threading.Lock()
+        self.memory = OrderedDict()
+        self.memory_items = memory_items
+        self.pending = {}
+        self.prefetched = []
+
+    def cached(self, path):
+        """已在内存中时直接返回结果，否则返回 None"""
+        with self.lock:
+            item = self.memory.get(path)
+            if item is not None:
+                self.memory.move_to_end(path)
+            return item
+
+    def request(self, path):
+        with self.lock:
+            future = self.pending.get(path)
+            if future is not None and not future.cancelled():
+                return future
+            future = self.pool.submit(self._load, path)
+            self.pending[path] = future
+        future.add_done_callback(lambda f: self._finished(path, f))
+        return future
+
+    def prefetch(self, paths, keep=None):
+        """预取 paths 中尚未生成的缩略图，并取消上一次预取中不再需要、还没开始的任务
+
+        keep 为当前选中的图片，即使在上一次的预取列表里也不会被取消。
+        """
+        wanted = set(paths)
+        wanted.add(keep)
+        for path, future in self.prefetched:
+            if path not in wanted:
+                future.cancel()
+        self.prefetched = [(path, self.request(path)) for path in paths if self.cached(path) is None]
+
+    def _finished(self, path, future):
+        with self.lock:
+            if self.pending.get(path) is future:
+                del self.pending[path]
+            if future.cancelled() or future.exception() is not None:
+                return
+            self.memory[path] = future.result()
+            self.memory.move_to_end(path)
+            while len(self.memory) > self.memory_items:
+                self.memory.popitem(last=False)
+
+    def _load(self, path):
+        item = self.cached(path)
+        if item is not None:
+            return item
+        key = None
+        if self.cache is not None:
+            key = content_key(path, self.max_size)
+            hit = self.cache.get(key)
+            if hit is not None:
+                return self._to_mode(hit[0]), hit[1]
+        with Image.open(path) as im:
+            full_size = im.size
+            im.draft(None, self.max_size)
+            proxy = im.convert(engine.native_mode(im))
+        proxy.thumbnail(self.max_size)
+        if key is not None:
+            self.cache.put(key, proxy, full_size)
+        return self._to_mode(proxy), full_size
+
+    def _to_mode(self, img):
+        # 缓存里按原图的模式保存，使用时再按后端需要转换
+        return img if self.native else img.convert("RGBA")
+
+    def shutdown(self):
+        self.pool.shutdown(wait=False, cancel_futures=True)
@@ -0,0 +1,312 @@
+import os
+import sys
+import time
+import queue
+import struct
+import select
+import argparse
+import threading
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor, wait, FIRST_COMPLETED
+
+import watermark_engine as engine
+from watermark_engine import SUPPORTED_FORMATS, TEMPLATE_FILE
+from export_manifest import ExportManifest, settings_digest, source_fingerprint
+
+try:
+    import ctypes
+    import ctypes.util
+except ImportError:
+    ctypes = None
+
+# inotify 常量，取自 <sys/inotify.h>
+IN_MODIFY = 0x00000002
+IN_CLOSE_WRITE = 0x00000008
+IN_MOVED_TO = 0x00000080
+IN_Q_OVERFLOW = 0x00004000
+IN_NONBLOCK = 0o4000
+IN_CLOEXEC = 0o2000000
+EVENT_HEADER = struct.Struct("iIII")
+
+DEFAULT_QUEUE_SIZE = 64
+DEFAULT_SETTLE = 2.0
+DEFAULT_INTERVAL = 1.0
+
+
+def _is_image(name):
+    # 以点开头的多为拷贝工具的临时文件，写完后才会改成正式文件名
+    return not name.startswith(".") and os.path.splitext(name)[1].lower() in SUPPORTED_FORMATS
+
+
+def _scan(folder):
+    """列出文件夹中的图片及其 (大小, 修改时间)，只用 scandir 自带的 stat 信息"""
+    entries = {}
+    with os.scandir(folder) as it:
+        for entry in it:
+            if _is_image(entry.name) and entry.is_file():
+                st = entry.stat()
+                entries[entry.path] = (st.st_size, st.st_mtime_ns)
+    return entries
+
+
+# ===== 文件变化检测 =====
+class PollingWatcher:
+    """定时用 scandir 扫描文件夹，与上一次的大小和修改时间比较，找出新增或变化的文件"""
+
+    def __init__(self, folder, interval=DEFAULT_INTERVAL):
+        self.folder = folder
+        self.interval = interval
+        self.snapshot = {}
+
+    def changes(self, timeout):
+        """等待至多 timeout 秒（不超过扫描间隔），返回新增或变化的文件路径"""
+        time.sleep(min(timeout, self.interval))
+        current = _scan(self.folder)
+        changed = [path for path, sig in current.items() if self.snapshot.get(path) != sig]
+        self.snapshot = current
+        return changed
+
+    def close(self):
+        pass
+
+
+class InotifyWatcher:
+    """通过 ctypes 调用 Linux inotify，只在文件写完关闭或被移入时收到通知，空闲时不扫描磁盘"""
+
+    def __init__(self, folder):
+        libc = ctypes.CDLL(ctypes.util.find_library("c") or "libc.so.6", use_errno=True)
+        self.folder = folder
+        self.fd = libc.inotify_init1(IN_NONBLOCK | IN_CLOEXEC)
+        if self.fd < 0:
+            raise OSError(ctypes.get_errno(), "inotify_init1 失败")
+        mask = IN_CLOSE_WRITE | IN_MOVED_TO | IN_MODIFY
+        if libc.inotify_add_watch(self.fd, os.fsencode(folder), mask) < 0:
+            errno = ctypes.get_errno()
+            os.close(self.fd)
+            raise OSError(errno, f"无法监视文件夹：{folder}")
+
+    def changes(self, timeout):
+        readable, _, _ = select.select([self.fd], [], [], timeout)
+        if not readable:
+            return []
+        try:
+            data = os.read(self.fd, 64 * 1024)
+        except BlockingIOError:
+            return []
+        changed = []
+        offset = 0
+        while offset < len(data):
+            _wd, mask, _cookie, length = EVENT_HEADER.unpack_from(data, offset)
+            name = data[offset + EVENT_HEADER.size:offset + EVENT_HEADER.size + length].rstrip(b"\0")
+            offset += EVENT_HEADER.size + length
+            if mask & IN_Q_OVERFLOW:
+                # 内核事件队列溢出会丢事件，退回全量扫描
+                return list(_scan(self.folder))
+            name = os.fsdecode(name)
+            if name and _is_image(name):
+                changed.append(os.path.join(self.folder, name))
+        return changed
+
+    def close(self):
+        os.close(self.fd)
+
+
+def make_watcher(folder, poll=False, interval=DEFAULT_INTERVAL):
+    """优先使用 inotify，不可用（非 Linux 或 poll=True）时退回轮询"""
+    if not poll and ctypes is not None and sys.platform.startswith("linux"):
+        try:
+            return InotifyWatcher(folder)
+        except (OSError, AttributeError) as e:
+            print(f"⚠️ inotify 不可用，改为轮询：{e}")
+    return PollingWatcher(folder, interval)
+
+
+class StabilityTracker:
+    """记录候选文件的大小和修改时间，连续 settle 秒都不变才认为已经写完"""
+
+    def __init__(self, settle=DEFAULT_SETTLE):
+        self.settle = settle
+        self.pending = {}
+
+    def add(self, path):
+        # 文件又有变化时重新计时
+        self.pending[path] = None
+
+    def ready(self):
+        now = time.monotonic()
+        done = []
+        for path, state in list(self.pending.items()):
+            try:
+                st = os.stat(path)
+            except OSError:
+                del self.pending[path]
+                continue
+            sig = (st.st_size, st.st_mtime_ns)
+            if state is None or state[0] != sig or st.st_size == 0:
+                self.pending[path] = (sig, now)
+            elif now - state[1] >= self.settle:
+                del self.pending[path]
+                done.append(path)
+        return done
+
+
+# ===== 监视与导出 =====
+def print_result(result):
+    name = os.path.basename(result.path)
+    if result.error:
+        print(f"❌ {name} -> {result.error}")
+    else:
+        print(f"✅ {name} 已保存到 {result.out_path}"
+              f"（编码 {result.encode_s * 1000:.0f} ms，{result.out_bytes / 1e6:.2f} MB）")
+
+
+def _watch_loop(watcher, tracker, work_queue, stop_event, initial):
+    """监视线程：把写完的文件放进有界队列；队列满时阻塞，不再读取新事件，形成背压"""
+    for path in initial:
+        tracker.add(path)
+    while not stop_event.is_set():
+        for path in watcher.changes(timeout=0.5 if tracker.pending else 1.0):
+            tracker.add(path)
+        for path in tracker.ready():
+            while not stop_event.is_set():
+                try:
+                    work_queue.put(path, timeout=0.5)
+                    break
+                except queue.Full:
+                    continue
+
+
+def watch(in_dir, out_dir, settings, workers=None, queue_size=DEFAULT_QUEUE_SIZE, settle=DEFAULT_SETTLE,
+          poll=False, interval=DEFAULT_INTERVAL, stop_event=None, on_result=None):
+    """持续监视 in_dir，把新增或变化的图片按 settings 导出到 out_dir，直到 stop_event 被设置
+
+    与"导出全部图片"走同一套渲染流程（watermark_engine.process_job），并用导出清单跳过
+    已经导出过且没有变化的文件，重启后不会重复处理。同一输出文件同时只有一个任务在写，
+    输出文件名与其他源文件相同的文件（如 a.jpg 与 a.png）报告错误后跳过。
+    同时处理的文件数不超过 workers，等待处理的文件不超过 queue_size。
+    """
+    if os.path.abspath(in_dir) == os.path.abspath(out_dir):
+        raise ValueError("输出文件夹不能与监视的文件夹相同")
+    os.makedirs(out_dir, exist_ok=True)
+    engine.check_backend(settings)
+    workers = workers or os.cpu_count() or 1
+    stop_event = stop_event or threading.Event()
+    on_result = on_result or print_result
+    manifest = ExportManifest(out_dir)
+    digest = settings_digest(settings)
+    work_queue = queue.Queue(maxsize=queue_size)
+    watcher = make_watcher(in_dir, poll, interval)
+    tracker = StabilityTracker(settle)
+    # 启动时已有的文件也交给稳定性检查，清单中未变化的会被跳过
+    initial = _scan(in_dir)
+    if isinstance(watcher, PollingWatcher):
+        watcher.snapshot = initial
+    thread = threading.Thread(target=_watch_loop, args=(watcher, tracker, work_queue, stop_event, initial),
+                              daemon=True)
+    thread.start()
+
+    in_flight = {}
+    busy = set()  # 正在写的输出文件名
+    deferred = {}  # 输出文件名 -> 等前一个任务写完再处理的源文件
+    ready = deque()
+    owners = {}  # 输出文件名 -> 本次监视中第一个写它的源文件
+    dirty = False
+    try:
+        with ProcessPoolExecutor(max_workers=workers) as pool:
+            while not stop_event.is_set() or in_flight:
+                # 进程池有空位时才从队列取文件，池满时队列随之积压
+                while len(in_flight) < workers and not stop_event.is_set():
+                    if ready:
+                        path = ready.popleft()
+                    else:
+                        try:
+                            path = work_queue.get(timeout=0.5 if not in_flight else 0)
+                        except queue.Empty:
+                            break
+                    out_name = os.path.basename(engine.output_path_for(path, out_dir, settings))
+                    owner = owners.setdefault(out_name, os.path.abspath(path))
+                    if owner != os.path.abspath(path):
+                        # a.jpg 与 a.png 导出后同名，后到的文件不再覆盖前一个的输出
+                        error = f"输出文件名与 {os.path.basename(owner)} 相同，已跳过"
+                        on_result(engine.ExportResult(path, None, error, False))
+                        continue
+                    if out_name in busy:
+                        # 同一文件处理期间又被改写，等这次写完再重新处理
+                        deferred[out_name] = path
+                        continue
+                    try:
+                        fingerprint = source_fingerprint(path)
+                    except OSError:
+                        continue
+                    if manifest.is_current(out_name, path, fingerprint, digest):
+                        continue
+                    future = pool.submit(engine.process_job, path, out_dir, settings)
+                    in_flight[future] = (out_name, path, fingerprint)
+                    busy.add(out_name)
+                if not in_flight:
+                    if dirty:
+                        manifest.save()
+                        dirty = False
+                    continue
+                done, _ = wait(in_flight, timeout=0.5, return_when=FIRST_COMPLETED)
+                for future in done:
+                    out_name, path, fingerprint = in_flight.pop(future)
+                    busy.discard(out_name)
+                    if out_name in deferred:
+                        ready.append(deferred.pop(out_name))
+                    result = future.result()
+                    if result.error is None:
+                        manifest.record(out_name, path, fingerprint, digest)
+                        dirty = True
+                    on_result(result)
+    finally:
+        stop_event.set()
+        thread.join()
+        watcher.close()
+        manifest.save()
+
+
+# ===== 命令行入口 =====
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="监视文件夹，新图片写完后自动按模板添加水印")
+    parser.add_argument("folder", help="要监视的文件夹")
+    parser.add_argument("-o", "--output", required=True, help="导出文件夹")
+    parser.add_argument("-t", "--template", help="templates.json 中的模板名称，默认使用上一次的模板")
+    parser.add_argument("--templates", default=TEMPLATE_FILE, help="模板文件路径")
+    parser.add_argument("-j", "--workers", type=int, default=None, help="进程数，默认 CPU 核数")
+    parser.add_argument("--queue-size", type=int, default=DEFAULT_QUEUE_SIZE,
+                        help="等待处理的文件数上限，队列满时暂停接收新文件")
+    parser.add_argument("--settle", type=float, default=DEFAULT_SETTLE,
+                        help="文件大小和修改时间保持不变多少秒后才认为已写完")
+    parser.add_argument("--poll", action="store_true", help="不使用 inotify，定时扫描文件夹")
+    parser.add_argument("--interval", type=float, default=DEFAULT_INTERVAL, help="轮询间隔（秒）")
+    args = parser.parse_args(argv)
+
+    templates = engine.load_templates(args.templates)
+    name = args.template or templates.get("_last_used")
+    if args.template and (args.template not in templates or args.template.startswith("_")):
+        print(f"❌ 模板不存在：{args.template}")
+        return 1
+    try:
+        settings = engine.normalize_settings(templates.get(name) if name else None,
+                                             engine.load_encoder_profiles(templates))
+        # 模板有错时每个新文件都会失败，启动前就报错退出
+        engine.check_settings(settings)
+        engine.check_backend(settings)
+    except (TypeError, ValueError, AttributeError, KeyError, RuntimeError) as e:
+        print(f"❌ 模板 {name or '默认设置'} 无效：{e}")
+        return 1
+    print(f"正在监视 {args.folder}，使用模板 {name or '默认设置'}，按 Ctrl+C 停止")
+    try:
+        watch(args.folder, args.output, settings, workers=args.workers, queue_size=args.queue_size,
+              settle=args.settle, poll=args.poll, interval=args.interval)
+    except KeyboardInterrupt:
+        print("已停止监视")
+    except (ValueError, RuntimeError, OSError) as e:
+        print(f"❌ {e}")
+        return 1
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
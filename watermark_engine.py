@@ -0,0 +1,1461 @@
+import os
+import sys
+import json
+import math
+import time
+import argparse
+import threading
+from collections import Counter, OrderedDict, deque, namedtuple
+from functools import lru_cache
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor, as_completed, wait, FIRST_COMPLETED
+from PIL import Image, ImageDraw, ImageFont, TiffImagePlugin
+from export_manifest import ExportManifest, settings_digest, source_fingerprint
+from instrument import NULL_TIMER, StageTimer, TraceWriter, summarize, format_summary, profile_call
+import numpy_blend
+
+SUPPORTED_FORMATS = ['.jpg', '.jpeg', '.png', '.bmp', '.tiff', '.tif', '.gif', '.webp']
+TEMPLATE_FILE = "templates.json"
+FONT_CANDIDATES = [
+    "C:\\Windows\\Fonts\\msyh.ttc",
+    "/usr/share/fonts/truetype/noto/NotoSansCJK-Regular.ttc",
+    "/System/Library/Fonts/STHeiti Medium.ttc",
+]
+
+# 扫描全景图可达数亿像素，放宽 Pillow 默认约 9000 万像素的解压炸弹限制
+Image.MAX_IMAGE_PIXELS = 1_000_000_000
+
+# 与 templates.json 中模板字段一致的默认设置
+DEFAULT_SETTINGS = {
+    "text": "示例水印",
+    "color": (255, 255, 255),  # RGB 元组，或 "auto" 按水印所在区域的亮度自动选黑或白
+    "alpha": 50,
+    "font_size": 5.0,
+    "position": "center",  # 锚点名称、(x, y) 坐标、"auto" 自动避开繁杂区域，或 "tile" 平铺
+    "tile_spacing": 10.0,  # 平铺时相邻水印的间距，占原图高度的百分比
+    "tile_angle": 30.0,  # 平铺时水印逆时针旋转的角度
+    "shadow": False,
+    "outline": False,
+    "scale_mode": "none",
+    "scale_value": "0",
+    "prefix": "",
+    "suffix": "_watermarked",
+    "format": "PNG",
+    "font_quantize": 0,
+    "tiled": "auto",
+    "backend": "pil",
+    "encoder": "default",
+}
+
+
+POSITIONS = ["left_top", "right_top", "center", "left_bottom", "right_bottom", "auto", "tile"]
+SCALE_MODES = ["none", "width", "height", "percent"]
+FONT_SIZE_RANGE = (1, 20)  # 字号占原图高度的百分比，与界面滑块的范围一致
+TILE_SPACING_RANGE = (0, 50)  # 平铺间距占原图高度的百分比
+
+# stats 仅在开启 trace 时给出，为 instrument.StageTimer.to_dict() 的结果
+# encode_s、out_bytes 为编码耗时（秒）和输出文件大小，成功导出时给出
+ExportResult = namedtuple("ExportResult", "path out_path error skipped stats encode_s out_bytes",
+                          defaults=(None, None, None))
+
+
+# ===== 字体选择 =====
+FONT_CACHE_SIZE = 16
+_font_path = None
+
+
+def find_font_path():
+    """查找可用的中文字体（环境变量 WATERMARK_FONT 优先），只在第一次调用时探测磁盘"""
+    global _font_path
+    if _font_path is None:
+        candidates = FONT_CANDIDATES
+        if os.environ.get("WATERMARK_FONT"):
+            candidates = [os.environ["WATERMARK_FONT"]] + candidates
+        for path in candidates:
+            if os.path.exists(path):
+                _font_path = path
+                break
+        else:
+            raise RuntimeError("未找到可用的TrueType字体，请安装中文字体")
+    return _font_path
+
+
+@lru_cache(maxsize=FONT_CACHE_SIZE)
+def load_font(path, size):
+    """按 (路径, 字号) 缓存已加载的字体，避免反复读取几十 MB 的 .ttc 文件"""
+    return ImageFont.truetype(path, size)
+
+
+def quantize_font_size(size, step):
+    """把字号对齐到按 step 比例递增的档位上（如 0.05 表示每档相差约 5%）"""
+    if step <= 0:
+        return size
+    return max(1, round((1 + step) ** round(math.log(size, 1 + step))))
+
+
+def get_font(img_height, font_percent=5.0, quantize=0, scale=1.0):
+    """按图片高度的百分比取中文字体；quantize > 0 时字号按比例分档以提高缓存命中率
+
+    scale 用于在缩小的代理图上绘制：字号先按原图高度计算，再乘以缩放比例。
+    """
+    font_size = quantize_font_size(max(12, int(img_height * font_percent / 100.0)), quantize)
+    if scale != 1.0:
+        font_size = max(1, round(font_size * scale))
+    return load_font(find_font_path(), font_size)
+
+
+# ===== 水印绘制 =====
+SPRITE_CACHE_SIZE = 32
+_sprite_cache = OrderedDict()
+_measure_draw = ImageDraw.Draw(Image.new("RGBA", (1, 1)))
+
+
+def _font_key(font):
+    path = getattr(font, "path", None)
+    if path is None:
+        return id(font)
+    return path, getattr(font, "index", 0), font.size
+
+
+def get_watermark_sprite(text, font, color=(255, 255, 255), alpha=0.5, shadow=False, outline=False):
+    """把文字、阴影和描边预先渲染到包围盒大小的贴图上
+
+    返回 (贴图, 贴图左上角相对绘制坐标的偏移, 文字宽高)。
+    同一文字、字体、颜色和透明度的贴图会被缓存，批量导出时只渲染一次。
+    """
+    key = (text, _font_key(font), tuple(color), int(255 * alpha), shadow, outline)
+    cached = _sprite_cache.get(key)
+    if cached is not None:
+        _sprite_cache.move_to_end(key)
+        return cached[1:]
+
+    bbox = _measure_draw.textbbox((0, 0), text, font=font)
+    # 阴影向右下偏移 2 像素，描边向四周各扩 1 像素
+    pad_lt = 1 if outline else 0
+    pad_rb = 2 if shadow else pad_lt
+    ox, oy = bbox[0] - pad_lt, bbox[1] - pad_lt
+    sprite = Image.new("RGBA", (bbox[2] - ox + pad_rb, bbox[3] - oy + pad_rb), (255, 255, 255, 0))
+    draw = ImageDraw.Draw(sprite)
+    pos = (-ox, -oy)
+
+    if shadow:
+        shadow_color = (0, 0, 0, int(255 * alpha))
+        draw.text((pos[0] + 2, pos[1] + 2), text, font=font, fill=shadow_color)
+    if outline:
+        outline_color = (0, 0, 0, int(255 * alpha))
+        offsets = [(-1, 0), (1, 0), (0, -1), (0, 1)]
+        for dx, dy in offsets:
+            draw.text((pos[0] + dx, pos[1] + dy), text, font=font, fill=outline_color)
+
+    rgba = (*color, int(255 * alpha))
+    draw.text(pos, text, font=font, fill=rgba)
+
+    result = (sprite, (ox, oy), (bbox[2] - bbox[0], bbox[3] - bbox[1]))
+    # 缓存里同时保留字体对象，避免以 id 为键的默认字体被回收后键被复用
+    _sprite_cache[key] = (font,) + result
+    if len(_sprite_cache) > SPRITE_CACHE_SIZE:
+        _sprite_cache.popitem(last=False)
+    return result
+
+
+def composite_sprite(img, sprite, dest):
+    """把贴图就地混合到 RGBA 图像的 dest 处，超出画面的部分被裁掉"""
+    x, y = dest
+    left, top = max(x, 0), max(y, 0)
+    right, bottom = min(x + sprite.width, img.width), min(y + sprite.height, img.height)
+    if left >= right or top >= bottom:
+        return img
+    img.alpha_composite(sprite, dest=(left, top), source=(left - x, top - y, right - x, bottom - y))
+    return img
+
+
+def composite_sprite_tiled(img, sprite, dest, tile_size=1024):
+    """按 tile_size 分块把贴图就地混合到 RGB 或 RGBA 图像上
+
+    只处理与贴图相交的图块，每次把一个图块转成 RGBA 合成后再写回，
+    额外内存只与图块大小有关，与整幅图像大小无关。
+    """
+    x, y = dest
+    left, top = max(x, 0), max(y, 0)
+    right, bottom = min(x + sprite.width, img.width), min(y + sprite.height, img.height)
+    for ty in range(top, bottom, tile_size):
+        for tx in range(left, right, tile_size):
+            box = (tx, ty, min(tx + tile_size, right), min(ty + tile_size, bottom))
+            tile = img.crop(box)
+            if tile.mode != "RGBA":
+                tile = tile.convert("RGBA")
+            tile.alpha_composite(sprite, source=(box[0] - x, box[1] - y, box[2] - x, box[3] - y))
+            img.paste(tile if img.mode == "RGBA" else tile.convert(img.mode), box[:2])
+    return img
+
+
+def anchor_position(position, img_size, text_size, margin=20):
+    """把锚点名称换算成文字左上角坐标；position 为 (x, y) 时原样返回"""
+    if isinstance(position, tuple):
+        return position
+    width, height = img_size
+    text_w, text_h = text_size
+    if position == "left_top":
+        return margin, margin
+    elif position == "right_top":
+        return width - text_w - margin, margin
+    elif position == "left_bottom":
+        return margin, height - text_h - margin
+    elif position == "right_bottom":
+        return width - text_w - margin, height - text_h - margin
+    return (width - text_w) // 2, (height - text_h) // 2
+
+
+# ===== 自动位置与颜色 =====
+PLACEMENT_SAMPLE_SIZE = 384  # 先最近邻采样到该长边，只读取采样到的像素，代价与原图分辨率无关
+PLACEMENT_PROXY_SIZE = 96  # 再平均缩小到该长边，在其上计算积分图
+PLACEMENT_STEPS = 24  # 自动位置在水平和竖直方向上各取的候选数
+CONTRAST_WEIGHT = 0.5  # 评分中亮度反差相对纹理（亮度标准差）的权重
+DARK_COLOR = (0, 0, 0)
+LIGHT_COLOR = (255, 255, 255)
+
+
+def analysis_proxy(img):
+    """把图像缩成长边约 PLACEMENT_PROXY_SIZE 的灰度图，用于评估各区域的亮度和纹理"""
+    w, h = img.size
+    scale = PLACEMENT_SAMPLE_SIZE / max(w, h)
+    if scale < 1:
+        img = img.resize((max(1, round(w * scale)), max(1, round(h * scale))), Image.NEAREST)
+    gray = img.convert("L")
+    scale = PLACEMENT_PROXY_SIZE / max(gray.size)
+    if scale < 1:
+        gray = gray.resize((max(1, round(gray.width * scale)), max(1, round(gray.height * scale))), Image.BOX)
+    return gray
+
+
+def integral_images(gray):
+    """返回灰度图亮度与亮度平方的积分图（(宽+1)×(高+1)，按行展开），任意矩形内的和只需 4 次查表"""
+    w, h = gray.size
+    data = gray.tobytes()
+    stride = w + 1
+    total = [0] * (stride * (h + 1))
+    squares = [0] * (stride * (h + 1))
+    for y in range(h):
+        row = row_sq = 0
+        above, here = y * stride, (y + 1) * stride
+        for x, v in enumerate(data[y * w:(y + 1) * w], 1):
+            row += v
+            row_sq += v * v
+            total[here + x] = total[above + x] + row
+            squares[here + x] = squares[above + x] + row_sq
+    return total, squares, stride
+
+
+def _region_stats(tables, box):
+    """矩形区域 (x0, y0, x1, y1) 内亮度的均值和标准差"""
+    total, squares, stride = tables
+    x0, y0, x1, y1 = box
+    n = (x1 - x0) * (y1 - y0)
+    corners = (y1 * stride + x1, y0 * stride + x1, y1 * stride + x0, y0 * stride + x0)
+    s = total[corners[0]] - total[corners[1]] - total[corners[2]] + total[corners[3]]
+    sq = squares[corners[0]] - squares[corners[1]] - squares[corners[2]] + squares[corners[3]]
+    mean = s / n
+    return mean, max(0.0, sq / n - mean * mean) ** 0.5
+
+
+def luminance(color):
+    return 0.299 * color[0] + 0.587 * color[1] + 0.114 * color[2]
+
+
+def contrast_color(mean):
+    """与区域平均亮度反差最大的颜色：亮区用黑色，暗区用白色"""
+    return DARK_COLOR if mean >= 128 else LIGHT_COLOR
+
+
+def auto_placement(img, text_size, position, color, margin):
+    """在缩小的灰度图上为水印选位置和颜色，返回 (位置, 颜色)
+
+    position 为 "auto" 时在离边缘 margin 以内的范围均匀取候选位置，用积分图求每个候选区域
+    亮度的均值和标准差，选纹理最少（标准差小）且与文字颜色反差最大的位置；
+    其他 position 保持不变（"tile" 按整幅图像计算）。color 为 "auto" 时按选定区域的平均亮度取黑或白。
+    """
+    gray = analysis_proxy(img)
+    tables = integral_images(gray)
+    kx, ky = gray.width / img.width, gray.height / img.height
+    text_w, text_h = text_size
+
+    def proxy_box(x, y, w, h):
+        x0 = min(max(0, int(x * kx)), gray.width - 1)
+        y0 = min(max(0, int(y * ky)), gray.height - 1)
+        return x0, y0, max(x0 + 1, min(gray.width, math.ceil((x + w) * kx))), \
+            max(y0 + 1, min(gray.height, math.ceil((y + h) * ky)))
+
+    if position == "auto":
+        def steps(length, size):
+            span = max(0, length - size - 2 * margin)
+            return sorted({margin + span * i // (PLACEMENT_STEPS - 1) for i in range(PLACEMENT_STEPS)})
+        best = None
+        for y in steps(img.height, text_h):
+            for x in steps(img.width, text_w):
+                mean, std = _region_stats(tables, proxy_box(x, y, text_w, text_h))
+                reference = luminance(contrast_color(mean) if color == "auto" else color)
+                cost = std - CONTRAST_WEIGHT * abs(mean - reference)
+                if best is None or cost < best[0]:
+                    best = (cost, (x, y), mean)
+        position, mean = best[1], best[2]
+    elif position == "tile":
+        mean, _ = _region_stats(tables, (0, 0, gray.width, gray.height))
+    else:
+        x, y = anchor_position(position, img.size, text_size, margin)
+        mean, _ = _region_stats(tables, proxy_box(x, y, text_w, text_h))
+    return position, contrast_color(mean) if color == "auto" else color
+
+
+# ===== 平铺水印 =====
+PATTERN_MIN_SIZE = 1024  # 平铺图案块的最小边长，块越大合成调用越少
+PATTERN_CACHE_SIZE = 8
+_pattern_cache = OrderedDict()
+
+
+def get_tile_pattern(sprite, angle, gap):
+    """把水印贴图旋转后排成可以无缝重复的图案块
+
+    奇数行错开半个单元，形成斜向交错的排列；图案块边长不小于 PATTERN_MIN_SIZE，
+    铺满整幅图像只需 (宽/块宽)×(高/块高) 次合成，与文字个数无关。
+    按 (贴图, 角度, 间距) 缓存，批量导出时旋转和排列只做一次。返回 (图案块, 单元宽高)。
+    """
+    key = (id(sprite), angle, gap)
+    cached = _pattern_cache.get(key)
+    if cached is not None and cached[0] is sprite:
+        _pattern_cache.move_to_end(key)
+        return cached[1:]
+    # 在预乘透明度下旋转，避免透明像素的颜色渗到文字边缘
+    tile = sprite.convert("RGBa").rotate(angle, resample=Image.Resampling.BICUBIC, expand=True).convert("RGBA")
+    cell_w, cell_h = tile.width + gap, tile.height + gap
+    cols = -(-PATTERN_MIN_SIZE // cell_w)
+    rows = -(-PATTERN_MIN_SIZE // (2 * cell_h)) * 2
+    block = Image.new("RGBA", (cols * cell_w, rows * cell_h), (255, 255, 255, 0))
+    for row in range(rows):
+        shift = cell_w // 2 if row % 2 else 0
+        # 错开的行在左边缘补上右边缘被裁掉的半个单元，图案块左右相接时无缝
+        for col in range(-1 if shift else 0, cols):
+            block.paste(tile, (col * cell_w + shift, row * cell_h))
+    result = (block, (cell_w, cell_h))
+    _pattern_cache[key] = (sprite,) + result
+    if len(_pattern_cache) > PATTERN_CACHE_SIZE:
+        _pattern_cache.popitem(last=False)
+    return result
+
+
+def pattern_positions(img_size, block_size, cell_size):
+    """平铺图案块在图像上的左上角坐标；图像中心对齐第一行第一个单元的中心"""
+    def starts(length, block, cell):
+        first = (length // 2 - cell // 2) % block
+        return range(first - block if first else 0, length, block)
+    return [(x, y) for y in starts(img_size[1], block_size[1], cell_size[1])
+            for x in starts(img_size[0], block_size[0], cell_size[0])]
+
+
+# ===== 缩放与保存 =====
+TILE_SIZE = 1024
+TILED_MIN_PIXELS = 64_000_000  # 超过该像素数的图片自动使用分块模式
+DRAFT_REDUCING_GAP = 2.0  # 缩小解码后至少保留目标尺寸的 2 倍，再用 LANCZOS 缩到目标尺寸
+
+
+def target_size(size, scale_mode, scale_value):
+    """按 width / height / percent 模式计算缩放后的尺寸，不需要缩放时返回 None"""
+    try:
+        value = float(scale_value)
+    except (TypeError, ValueError):
+        return None
+    if value <= 0 or scale_mode == "none":
+        return None
+    w, h = size
+    if scale_mode == "width":
+        new_w = int(value)
+        new_h = int(h * new_w / w)
+    elif scale_mode == "height":
+        new_h = int(value)
+        new_w = int(w * new_h / h)
+    elif scale_mode == "percent":
+        scale = value / 100.0
+        new_w = int(w * scale)
+        new_h = int(h * scale)
+    else:
+        return None
+    return new_w, new_h
+
+
+def resize_image(img, scale_mode, scale_value):
+    """按 width / height / percent 模式缩放，数值无效时原样返回"""
+    size = target_size(img.size, scale_mode, scale_value)
+    if size is None:
+        return img
+    return img.resize(size, Image.LANCZOS)
+
+
+OUTPUT_FORMATS = ["PNG", "JPEG", "WEBP", "GIF", "TIFF"]
+# 编码档位：fast 追求速度，archive 追求体积，default 与原来的保存参数一致。
+# templates.json 中的 "_encoder_profiles" 可按同样的结构覆盖或新增档位。
+ENCODER_PROFILES = {
+    "fast": {
+        "PNG": {"compress_level": 1},
+        "JPEG": {"quality": 90, "subsampling": "4:2:0"},
+        "WEBP": {"quality": 80, "method": 0},
+        "GIF": {"optimize": False},
+        "TIFF": {},
+    },
+    "default": {
+        "PNG": {},
+        "JPEG": {"quality": 95},
+        "WEBP": {"quality": 90, "method": 4},
+        "GIF": {},
+        "TIFF": {"compression": "tiff_lzw"},
+    },
+    "archive": {
+        "PNG": {"compress_level": 9, "optimize": True},
+        "JPEG": {"quality": 90, "optimize": True, "progressive": True, "subsampling": "4:2:0"},
+        "WEBP": {"lossless": True, "quality": 100, "method": 6},
+        "GIF": {"optimize": True},
+        "TIFF": {"compression": "tiff_adobe_deflate"},
+    },
+}
+
+
+def load_encoder_profiles(templates=None):
+    """内置档位与模板文件中 "_encoder_profiles" 合并，同名档位按格式覆盖"""
+    profiles = {name: dict(formats) for name, formats in ENCODER_PROFILES.items()}
+    for name, formats in (templates or {}).get("_encoder_profiles", {}).items():
+        profiles.setdefault(name, {}).update({fmt.upper(): options for fmt, options in formats.items()})
+    return profiles
+
+
+def encoder_options(fmt, profile="default", profiles=None):
+    """某档位下某格式的保存参数，档位不存在时使用 default"""
+    profiles = profiles or ENCODER_PROFILES
+    formats = profiles.get(profile) or profiles.get("default") or ENCODER_PROFILES["default"]
+    return dict(formats.get(fmt.upper(), {}))
+
+
+def save_image(img, out_path, fmt, options=None):
+    """按格式保存，options 为 Pillow 的编码参数，默认取 default 档位"""
+    fmt = fmt.upper()
+    if options is None:
+        options = encoder_options(fmt)
+    if fmt == "JPEG":
+        # 已是 RGB 时直接编码，convert 同模式也会复制一整幅图像
+        (img if img.mode == "RGB" else img.convert("RGB")).save(out_path, format="JPEG", **options)
+    elif fmt == "WEBP":
+        (img if img.mode in ("RGB", "RGBA") else img.convert("RGBA")).save(out_path, format="WEBP", **options)
+    elif fmt in ("GIF", "TIFF"):
+        img.save(out_path, format=fmt, **options)
+    else:
+        img.save(out_path, format="PNG", **options)
+
+
+def native_mode(im):
+    """不丢失信息的最小合成模式：有透明通道时为 RGBA，否则为 RGB"""
+    has_alpha = im.mode in ("RGBA", "LA", "PA") or "transparency" in im.info
+    return "RGBA" if has_alpha else "RGB"
+
+
+# ===== 模板与设置 =====
+def load_templates(path=TEMPLATE_FILE):
+    if os.path.exists(path):
+        with open(path, "r", encoding="utf-8") as f:
+            return json.load(f)
+    return {}
+
+
+def normalize_settings(tpl=None, profiles=None, **overrides):
+    """把模板字典补全为完整的导出设置（颜色转元组、拖拽坐标转元组）
+
+    encoder 档位按 profiles（load_encoder_profiles 的结果）展开为 encoder_options，
+    随设置一起传给工作进程，也参与增量导出的设置哈希。
+    """
+    settings = dict(DEFAULT_SETTINGS)
+    settings.update(tpl or {})
+    settings.update({k: v for k, v in overrides.items() if v is not None})
+    # 模板里 position 可能是锚点名称、拖拽坐标或 None；旧模板另有 watermark_pos 字段
+    position = settings.pop("watermark_pos", None) or settings.get("position") or "center"
+    if isinstance(position, list):
+        position = tuple(position)
+    settings["position"] = position
+    if settings["color"] != "auto":
+        settings["color"] = tuple(settings["color"])
+    settings["tile_spacing"] = float(settings["tile_spacing"])
+    settings["tile_angle"] = float(settings["tile_angle"])
+    settings["format"] = settings["format"].upper()
+    settings["encoder_options"] = encoder_options(settings["format"], settings["encoder"], profiles)
+    return settings
+
+
+def output_path_for(path, out_dir, settings):
+    name, _ = os.path.splitext(os.path.basename(path))
+    fmt = settings["format"]
+    return os.path.join(out_dir, f"{settings['prefix']}{name}{settings['suffix']}.{fmt.lower()}")
+
+
+# ===== 渲染 =====
+def layout_text(img_size, settings, source_size, timer=NULL_TIMER, image=None):
+    """计算输出尺寸 img_size 上的水印贴图和文字位置，返回 (贴图, 贴图偏移, 文字左上角坐标)
+
+    贴图左上角位于 文字坐标 + 贴图偏移。界面拖动水印时用文字坐标换算回原图坐标。
+    自动位置（position 为 "auto"）和自动颜色（color 为 "auto"）要分析图像内容，须给出 image。
+    """
+    scale = img_size[0] / source_size[0]
+    position = settings["position"]
+    color = settings["color"]
+    if isinstance(position, tuple):
+        # 四舍五入而不是截断：界面把拖放位置除以缩放比例四舍五入后保存，换算回来须落在同一像素
+        position = (round(position[0] * scale), round(position[1] * scale))
+    margin = round(20 * scale)
+    with timer.stage("font"):
+        font = get_font(source_size[1], settings["font_size"], settings["font_quantize"], scale=scale)
+    if position == "auto" or color == "auto":
+        if image is None:
+            raise ValueError("自动位置和自动颜色需要根据图像内容计算")
+        with timer.stage("placement"):
+            bbox = _measure_draw.textbbox((0, 0), settings["text"], font=font)
+            position, color = auto_placement(image, (bbox[2] - bbox[0], bbox[3] - bbox[1]), position, color,
+                                             margin)
+    with timer.stage("text"):
+        sprite, (ox, oy), text_size = get_watermark_sprite(settings["text"], font, color,
+                                                           settings["alpha"] / 100.0,
+                                                           settings["shadow"], settings["outline"])
+    return sprite, (ox, oy), anchor_position(position, img_size, text_size, margin)
+
+
+def layout_watermark(img_size, settings, source_size, timer=NULL_TIMER, image=None):
+    """计算输出尺寸 img_size 上的水印贴图及其左上角坐标，返回 (贴图, 坐标)
+
+    字号、边距和拖拽坐标都先按原图尺寸 source_size 计算，再按实际缩放比例换算，
+    因此水印在输出图上的比例与"先加水印再缩放"一致，但只在输出分辨率上绘制。
+    """
+    sprite, (ox, oy), pos = layout_text(img_size, settings, source_size, timer, image)
+    return sprite, (pos[0] + ox, pos[1] + oy)
+
+
+def layout_pattern(img_size, settings, source_size, timer=NULL_TIMER, image=None):
+    """平铺模式下的图案块及其在输出图上的所有位置，返回 (图案块, 坐标列表)
+
+    字号和间距与单个水印一样按原图尺寸计算后换算到输出尺寸。
+    """
+    scale = img_size[0] / source_size[0]
+    sprite, _, _ = layout_text(img_size, settings, source_size, timer, image)
+    if sprite.width == 0 or sprite.height == 0:
+        # 水印文字为空时没有可平铺的内容，间距为 0 时单元宽高也为 0
+        return sprite, []
+    gap = max(0, round(source_size[1] * settings["tile_spacing"] / 100.0 * scale))
+    with timer.stage("text"):
+        block, cell = get_tile_pattern(sprite, settings["tile_angle"], gap)
+    return block, pattern_positions(img_size, block.size, cell)
+
+
+def plan_watermark(img, settings, source_size, timer=NULL_TIMER):
+    """计算输出尺寸的 img 上要合成的贴图及其所有左上角坐标，返回 (贴图, 坐标列表)
+
+    单个水印只有一个坐标，平铺模式为图案块的各个位置。多帧图像的各帧共用同一份结果。
+    """
+    if settings["position"] == "tile":
+        return layout_pattern(img.size, settings, source_size, timer, img)
+    sprite, dest = layout_watermark(img.size, settings, source_size, timer, img)
+    return sprite, [dest]
+
+
+def watermark_for_size(img, settings, source_size, tile_size=None, in_place=False, timer=NULL_TIMER):
+    """给已缩放到输出尺寸的图像加水印
+
+    默认在副本上合成，in_place=True 时直接修改 img。
+    backend 为 "numpy" 且 img 为 RGB 时用 numpy 只混合水印覆盖的区域；
+    给出 tile_size 时分块合成；其余情况 img 须为 RGBA。
+    position 为 "tile" 时把同一个图案块逐块合成到整幅图像上。
+    """
+    plan = plan_watermark(img, settings, source_size, timer)
+    with timer.stage("composite"):
+        if not in_place:
+            img = img.copy()
+        return composite_plan(img, plan, settings, tile_size)
+
+
+def composite_plan(img, plan, settings, tile_size=None):
+    """把 plan_watermark 算出的贴图就地合成到 img 的各个位置，合成方式见 watermark_for_size"""
+    sprite, dests = plan
+    use_numpy = settings["backend"] == "numpy" and img.mode == "RGB"
+    if use_numpy and settings["position"] == "tile":
+        # 图案块覆盖整幅图像，numpy 的逐像素整数运算反而比 Pillow 分块合成慢，输出两者一致
+        use_numpy, tile_size = False, tile_size or TILE_SIZE
+    for dest in dests:
+        if use_numpy:
+            numpy_blend.blend_sprite_rgb(img, sprite, dest)
+        elif tile_size:
+            composite_sprite_tiled(img, sprite, dest, tile_size)
+        else:
+            composite_sprite(img, sprite, dest)
+    return img
+
+
+def use_tiled(source_size, settings):
+    """判断是否使用分块模式：tiled 为 "on"/"off" 时强制开关，"auto" 时按像素数决定"""
+    tiled = settings["tiled"]
+    if tiled == "auto":
+        return source_size[0] * source_size[1] >= TILED_MIN_PIXELS
+    return tiled == "on"
+
+
+def preferred_backend():
+    """已安装 numpy 时优先使用 numpy 后端"""
+    return "numpy" if numpy_blend.available() else "pil"
+
+
+def check_backend(settings):
+    if settings["backend"] == "numpy" and not numpy_blend.available():
+        raise RuntimeError("未安装 numpy，无法使用 numpy 合成后端")
+
+
+def _is_number(value):
+    return isinstance(value, (int, float)) and not isinstance(value, bool)
+
+
+def check_settings(settings):
+    """检查 normalize_settings 的结果，字段类型或取值不对时抛出 ValueError
+
+    模板来自界面时总是合法的；HTTP 服务和命令行读到的模板可能是手写的，
+    不检查的话错误要到渲染时才以 TypeError 等形式出现。
+    """
+    color = settings["color"]
+    if color != "auto" and not (len(color) == 3 and all(isinstance(c, int) and not isinstance(c, bool)
+                                                        and 0 <= c <= 255 for c in color)):
+        raise ValueError("color 应为 [R, G, B]（0-255 的整数）或 \"auto\"")
+    position = settings["position"]
+    if isinstance(position, tuple):
+        if len(position) != 2 or not all(_is_number(v) for v in position):
+            raise ValueError(f"position 坐标应为 [x, y]：{list(position)}")
+    elif position not in POSITIONS:
+        raise ValueError(f"position 应为 {'、'.join(POSITIONS)} 之一或 [x, y]：{position}")
+    if not isinstance(settings["text"], str):
+        raise ValueError("text 应为字符串")
+    if not _is_number(settings["alpha"]) or not 0 <= settings["alpha"] <= 100:
+        raise ValueError(f"alpha 应为 0-100 的数：{settings['alpha']}")
+    # 字号和平铺间距过大时贴图或图案块会大到耗尽内存，范围与界面滑块一致
+    low, high = FONT_SIZE_RANGE
+    if not _is_number(settings["font_size"]) or not low <= settings["font_size"] <= high:
+        raise ValueError(f"font_size 应为 {low}-{high} 的数：{settings['font_size']}")
+    low, high = TILE_SPACING_RANGE
+    if not low <= settings["tile_spacing"] <= high:
+        raise ValueError(f"tile_spacing 应为 {low}-{high} 的数：{settings['tile_spacing']}")
+    if not math.isfinite(settings["tile_angle"]):
+        raise ValueError(f"tile_angle 应为有限的数：{settings['tile_angle']}")
+    if not _is_number(settings["font_quantize"]) or settings["font_quantize"] < 0:
+        raise ValueError(f"font_quantize 应为非负数：{settings['font_quantize']}")
+    if settings["scale_mode"] not in SCALE_MODES:
+        raise ValueError(f"scale_mode 应为 {'、'.join(SCALE_MODES)} 之一：{settings['scale_mode']}")
+    for key in ("prefix", "suffix"):
+        # 前后缀会拼进输出文件名，不能带路径分隔符写到输出文件夹之外
+        if not isinstance(settings[key], str) or "/" in settings[key] or os.sep in settings[key]:
+            raise ValueError(f"{key} 应为不含路径分隔符的字符串")
+    if settings["format"] not in OUTPUT_FORMATS:
+        raise ValueError(f"format 应为 {'、'.join(OUTPUT_FORMATS)} 之一：{settings['format']}")
+    if settings["tiled"] not in ("auto", "on", "off"):
+        raise ValueError(f"tiled 应为 auto、on 或 off：{settings['tiled']}")
+    if settings["backend"] not in ("pil", "numpy"):
+        raise ValueError(f"backend 应为 pil 或 numpy：{settings['backend']}")
+
+
+def open_for_export(path, settings, timer=NULL_TIMER):
+    """解码源图并缩放到输出尺寸，返回 (图像, 原图尺寸)
+
+    需要缩小时，JPEG 先用 draft 在 DCT 域按 1/2、1/4、1/8 缩小解码，分块模式下
+    其余格式再用 reduce 快速降采样，之后的格式转换和合成都只处理输出尺寸的像素。
+    普通模式返回 RGBA 图像；分块模式和 numpy 后端不做整幅 RGBA 转换，
+    不透明的图保持 RGB，缩放也在 RGB 上进行。
+    """
+    with timer.stage("open"):
+        im = Image.open(path)
+    img = None
+    try:
+        source_size = im.size
+        tiled = use_tiled(source_size, settings)
+        size = target_size(source_size, settings["scale_mode"], settings["scale_value"])
+        with timer.stage("decode"):
+            if size is not None:
+                im.draft(None, (int(size[0] * DRAFT_REDUCING_GAP), int(size[1] * DRAFT_REDUCING_GAP)))
+            im.load()
+        with timer.stage("convert"):
+            if tiled or settings["backend"] == "numpy":
+                mode = native_mode(im)
+                img = im if im.mode == mode else im.convert(mode)
+            else:
+                img = im.convert("RGBA")
+    finally:
+        if img is not im:
+            im.close()
+    if size is not None and img.size != size:
+        with timer.stage("resize"):
+            # Pillow 缩放 RGBA 时会忽略 reducing_gap；numpy 后端在 RGB 上同样不用它，输出才与 pil 后端一致
+            img = img.resize(size, Image.LANCZOS, reducing_gap=DRAFT_REDUCING_GAP if tiled else None)
+    timer.count(source_pixels=source_size[0] * source_size[1], output_pixels=img.width * img.height)
+    return img, source_size
+
+
+def process_file(path, out_dir, settings, timer=NULL_TIMER):
+    """单个文件的完整流程：解码、缩放、加水印、编码；供进程池调用
+
+    timer 为 instrument.StageTimer 时记录各阶段耗时和读写字节数。
+    """
+    check_backend(settings)
+    if exports_frames(path, settings):
+        return process_frames(path, out_dir, settings, timer)
+    img, source_size = open_for_export(path, settings, timer)
+    try:
+        # 解码出的图像只在这里使用，直接就地合成，不再复制整幅图像
+        tile_size = TILE_SIZE if use_tiled(source_size, settings) else None
+        out_img = watermark_for_size(img, settings, source_size, tile_size=tile_size, in_place=True, timer=timer)
+        out_path = output_path_for(path, out_dir, settings)
+        with timer.stage("encode"):
+            save_atomic(out_img, out_path, settings["format"], settings.get("encoder_options"))
+    finally:
+        img.close()
+    timer.count(bytes_read=os.path.getsize(path), bytes_written=os.path.getsize(out_path))
+    return out_path
+
+
+def save_atomic(img, out_path, fmt, options=None):
+    """先写到 .part 临时文件再改名，中途失败或被中断时不会留下不完整的输出文件"""
+    write_atomic(out_path, lambda tmp_path: save_image(img, tmp_path, fmt, options))
+
+
+def write_atomic(out_path, write):
+    """调用 write(临时文件路径) 写出文件后再改名为 out_path
+
+    临时文件名带进程号和线程号，同时写同一输出的任务不会互相覆盖或改走对方的临时文件。
+    """
+    tmp_path = f"{out_path}.{os.getpid()}.{threading.get_ident()}.part"
+    try:
+        write(tmp_path)
+        os.replace(tmp_path, out_path)
+    except BaseException:
+        if os.path.exists(tmp_path):
+            os.remove(tmp_path)
+        raise
+
+
+# ===== 多帧图像 =====
+MULTIFRAME_FORMATS = ("GIF", "PNG", "WEBP", "TIFF")  # 可能含多帧的输入格式（APNG 属于 PNG），也是可写多帧的输出格式
+FRAME_CHUNK = 8  # 同时在内存中渲染的帧数上限
+FRAME_WORKERS = 4
+
+
+def is_multiframe(path):
+    """只读文件头判断是否为动图或多页 TIFF；JPEG 等格式直接返回 False，不去数帧"""
+    try:
+        with Image.open(path) as im:
+            return im.format in MULTIFRAME_FORMATS and getattr(im, "n_frames", 1) > 1
+    except (OSError, ValueError):
+        return False
+
+
+def exports_frames(path, settings):
+    """源图有多帧且导出格式能写多帧时返回 True；导出为 JPEG 时只导出第一帧，走单帧流程"""
+    return settings["format"] in MULTIFRAME_FORMATS and is_multiframe(path)
+
+
+def frame_sizes(im):
+    """各帧的尺寸（去重）；GIF、APNG 和 WebP 动图所有帧都是画布尺寸，只有多页 TIFF 要逐页读取页头"""
+    if im.format != "TIFF":
+        return {im.size}
+    sizes = set()
+    for index in range(im.n_frames):
+        im.seek(index)
+        sizes.add(im.size)
+    im.seek(0)
+    return sizes
+
+
+def _frame_info(im):
+    """当前帧需要原样写回的参数：时长，以及 GIF/APNG 的处置方式和 APNG 的混合方式"""
+    info = {"duration": im.info.get("duration", 0)}
+    if im.format == "GIF":
+        info["disposal"] = getattr(im, "disposal_method", 0)
+    elif "disposal" in im.info:
+        info["disposal"] = im.info["disposal"]
+    if "blend" in im.info:
+        info["blend"] = im.info["blend"]
+    return info
+
+
+def _render_frame(frame, size, settings, plan, tile_size, has_alpha):
+    """在线程池中缩放一帧并合成水印；Pillow 的缩放和合成会释放 GIL，多帧可以并行"""
+    if frame.size != size:
+        frame = frame.resize(size, Image.LANCZOS, reducing_gap=DRAFT_REDUCING_GAP if tile_size else None)
+    composite_plan(frame, plan, settings, tile_size)
+    return frame if has_alpha or frame.mode == "RGB" else frame.convert("RGB")
+
+
+def render_frames(im, settings, timer=NULL_TIMER):
+    """逐帧解码并加水印，按顺序产出 (帧, 帧参数)
+
+    解码按顺序在当前线程进行，缩放和合成分发到线程池，同时在处理的帧不超过 FRAME_CHUNK，
+    内存与总帧数无关。贴图和位置按帧尺寸只计算一次（多页 TIFF 各页尺寸可能不同），
+    自动位置和颜色按该尺寸的第一帧确定，之后各帧保持一致，动画中水印不会跳动。
+    与单帧导出一样，分块模式和 numpy 后端下不透明的帧保持 RGB，分块模式下分块合成。
+    """
+    layouts = {}
+    pending = deque()
+    with ThreadPoolExecutor(max_workers=min(FRAME_WORKERS, os.cpu_count() or 1)) as pool:
+        for index in range(im.n_frames):
+            with timer.stage("decode"):
+                im.seek(index)
+                im.load()
+            # WebP 等格式在解码后才给出本帧的时长
+            info = _frame_info(im)
+            source_size = im.size
+            tiled = use_tiled(source_size, settings)
+            with timer.stage("convert"):
+                mode = native_mode(im) if tiled or settings["backend"] == "numpy" else "RGBA"
+                frame = im.convert(mode)
+                has_alpha = native_mode(im) == "RGBA"
+            layout = layouts.get(source_size)
+            if layout is None:
+                size = target_size(source_size, settings["scale_mode"], settings["scale_value"]) or source_size
+                if frame.size != size:
+                    # 该尺寸的第一帧在这里缩放，算出布局后直接交给线程池合成，不再缩放第二次
+                    with timer.stage("resize"):
+                        frame = frame.resize(size, Image.LANCZOS,
+                                             reducing_gap=DRAFT_REDUCING_GAP if tiled else None)
+                plan = plan_watermark(frame, settings, source_size, timer)
+                layout = layouts[source_size] = (size, plan, TILE_SIZE if tiled else None)
+            size, plan, tile_size = layout
+            pending.append((pool.submit(_render_frame, frame, size, settings, plan, tile_size, has_alpha), info))
+            if len(pending) >= FRAME_CHUNK:
+                future, info = pending.popleft()
+                with timer.stage("composite"):
+                    result = future.result()
+                yield result, info
+        while pending:
+            future, info = pending.popleft()
+            with timer.stage("composite"):
+                result = future.result()
+            yield result, info
+
+
+def write_frames(frames, out, fmt, options, source_format, source_info):
+    """把 render_frames 产出的帧写成多帧文件，out 为路径或文件对象
+
+    TIFF 用 AppendingTiffWriter 逐页写出，不保留已写的页；GIF、APNG 和 WebP 动图由 Pillow
+    一次编码，所有帧要先收齐（已是输出尺寸）。时长和循环次数总是保留，处置方式和混合方式
+    只在输出格式与输入相同时保留（GIF 与 APNG 的取值含义不同）。
+    """
+    if fmt == "TIFF":
+        with TiffImagePlugin.AppendingTiffWriter(out, new=True) as tf:
+            for frame, _ in frames:
+                frame.save(tf, format="TIFF", **options)
+                tf.newFrame()
+        return
+    frames = list(frames)
+    images = [frame for frame, _ in frames]
+    params = {"duration": [info["duration"] for _, info in frames]}
+    if "loop" in source_info:
+        params["loop"] = source_info["loop"]
+    if fmt == "WEBP" and "background" in source_info and isinstance(source_info["background"], tuple):
+        params["background"] = source_info["background"]
+    if fmt == source_format:
+        for key in ("disposal", "blend"):
+            if all(key in info for _, info in frames):
+                params[key] = [info[key] for _, info in frames]
+    images[0].save(out, format=fmt, save_all=True, append_images=images[1:], **params, **options)
+
+
+def _timed_iter(iterator, spent):
+    """逐项转发 iterator，把取下一项花费的时间累加到 spent[0]"""
+    while True:
+        start = time.perf_counter()
+        try:
+            item = next(iterator)
+        except StopIteration:
+            return
+        finally:
+            spent[0] += time.perf_counter() - start
+        yield item
+
+
+def encode_frames(im, out, settings, timer=NULL_TIMER):
+    """把已打开的多帧图像 im 逐帧加水印后写到 out（路径或文件对象）
+
+    GIF、APNG 和 WebP 动图的所有帧尺寸相同，各页尺寸不同的 TIFF 只能导出为 TIFF。
+    """
+    if settings["format"] not in MULTIFRAME_FORMATS:
+        raise ValueError(f"{settings['format']} 不支持多帧图像，请导出为 PNG、WEBP、GIF 或 TIFF")
+    if settings["format"] != "TIFF" and len(frame_sizes(im)) > 1:
+        raise ValueError(f"各页尺寸不同的多页 TIFF 不能导出为 {settings['format']}，请导出为 TIFF")
+    spent = [0.0]
+    frames = _timed_iter(render_frames(im, settings, timer), spent)
+    start = time.perf_counter()
+    write_frames(frames, out, settings["format"], settings.get("encoder_options") or {}, im.format, dict(im.info))
+    # 帧是边解码、渲染边编码的，编码耗时 = 写文件总耗时 - 生成各帧的耗时
+    timer.add("encode", time.perf_counter() - start - spent[0])
+    timer.count(source_pixels=im.width * im.height * im.n_frames, frames=im.n_frames)
+
+
+def process_frames(path, out_dir, settings, timer=NULL_TIMER):
+    """多帧图像（GIF/WebP 动图、APNG、多页 TIFF）逐帧加水印，保留各帧时长、循环次数和处置方式"""
+    out_path = output_path_for(path, out_dir, settings)
+    with timer.stage("open"):
+        im = Image.open(path)
+    with im:
+        write_atomic(out_path, lambda tmp_path: encode_frames(im, tmp_path, settings, timer))
+    timer.count(bytes_read=os.path.getsize(path), bytes_written=os.path.getsize(out_path))
+    return out_path
+
+
+def process_job(path, out_dir, settings, trace=False):
+    """导出单个文件并把结果或异常包装成 ExportResult，供批量导出和监视模式的进程池调用"""
+    # 编码耗时和输出大小总要报告，计时本身开销可以忽略，因此总是使用 StageTimer
+    timer = StageTimer(path)
+    try:
+        out_path = process_file(path, out_dir, settings, timer)
+        return ExportResult(path, out_path, None, False, timer.to_dict() if trace else None,
+                            timer.stages.get("encode"), timer.counters.get("bytes_written"))
+    except Exception as e:
+        return ExportResult(path, None, f"{type(e).__name__}: {e}", False)
+
+
+def check_output_dir(paths, out_dir):
+    """禁止导出到原图片所在文件夹，返回第一个冲突的文件路径"""
+    out_dir = os.path.abspath(out_dir)
+    for path in paths:
+        if os.path.abspath(os.path.dirname(path)) == out_dir:
+            return path
+    return None
+
+
+def check_output_names(paths, out_dir, settings):
+    """找出输出文件名相同的两个源文件（如 a.jpg 与 a.png），返回第一对 (源文件, 源文件)，没有时返回 None
+
+    settings 为多规格导出的目标列表时检查全部目标的输出。
+    """
+    targets = settings if isinstance(settings, list) else [settings]
+    owners = {}
+    for index, path in enumerate(paths):
+        for target in targets:
+            key = os.path.normcase(os.path.abspath(output_path_for(path, out_dir, target)))
+            other = owners.setdefault(key, index)
+            if other != index:
+                return paths[other], path
+    return None
+
+
+def duplicate_output_error(pair):
+    return (f"{os.path.basename(pair[0])} 与 {os.path.basename(pair[1])} 的输出文件名相同，导出已取消！"
+            "请给其中一个改名")
+
+
+def _fingerprint_or_none(path, content_hash):
+    try:
+        return source_fingerprint(path, content_hash)
+    except OSError:
+        return None
+
+
+def export_batch(paths, out_dir, settings, workers=None, ordered=True, manifest=None, content_hash=False,
+                 cancel_event=None, trace=False, memory_budget=None, order=None):
+    """批量导出，逐个产出 ExportResult(源路径, 输出路径, 错误信息, 是否跳过)
+
+    workers 为进程数（默认 CPU 核数，1 表示在当前进程串行处理）；
+    ordered=False 时按完成先后产出结果。
+    cancel_event（threading.Event）被设置后不再开始新的文件，尚未开始的任务全部取消；
+    正在处理的文件写完整后才结束，输出都是先写临时文件再改名，不会留下半个文件。
+    两个源文件的输出文件名相同（如 a.jpg 与 a.png）时抛出 ValueError，不会开始导出。
+    trace=True 时在每个结果的 stats 中给出各阶段耗时和读写统计。
+    memory_budget（字节）给出时按文件头估计每张图的内存，同时处理的图片估计内存之和不超过预算；
+    order 为 "large"/"small" 时大图或小图优先开始。
+    给出 manifest（ExportManifest）时增量导出：源文件指纹和设置哈希都没变、输出文件也还在的
+    图片不再渲染，先以 skipped=True 产出；成功导出的图片记入清单，结束时保存清单。
+    """
+    paths = list(paths)
+    conflict = check_output_dir(paths, out_dir)
+    if conflict:
+        raise ValueError(f"文件 {os.path.basename(conflict)} 位于输出目录中，导出已取消！")
+    duplicate = check_output_names(paths, out_dir, settings)
+    if duplicate:
+        raise ValueError(duplicate_output_error(duplicate))
+    os.makedirs(out_dir, exist_ok=True)
+
+    if manifest is None:
+        yield from _run_jobs(paths, out_dir, settings, workers, ordered, cancel_event, trace,
+                             memory_budget=memory_budget, order=order)
+        return
+
+    digest = settings_digest(settings)
+    with ThreadPoolExecutor() as pool:
+        fingerprints = dict(zip(paths, pool.map(lambda p: _fingerprint_or_none(p, content_hash), paths)))
+    pending = []
+    for path in paths:
+        out_path = output_path_for(path, out_dir, settings)
+        fingerprint = fingerprints[path]
+        if fingerprint is not None and manifest.is_current(os.path.basename(out_path), path, fingerprint, digest):
+            yield ExportResult(path, out_path, None, True)
+        else:
+            pending.append(path)
+    try:
+        for result in _run_jobs(pending, out_dir, settings, workers, ordered, cancel_event, trace,
+                                memory_budget=memory_budget, order=order):
+            if result.error is None and fingerprints[result.path] is not None:
+                manifest.record(os.path.basename(result.out_path), result.path, fingerprints[result.path], digest)
+            yield result
+    finally:
+        manifest.save()
+
+
+# ===== 内存预算调度 =====
+PIXEL_BYTES = 4  # Pillow 的 RGB 和 RGBA 图像每像素都占 4 字节
+JOB_OVERHEAD_BYTES = 16 * 1024 * 1024  # 字体、贴图、编码缓冲等与图像尺寸无关的开销
+JOB_ORDERS = ["input", "large", "small"]
+# Pillow 编码多帧文件时每个输出帧在内存中的份数：收齐的帧本身，加上 GIF 量化、WebP 编码缓冲
+# 或 APNG 为比较相邻帧保留的副本（300 帧 800x600 实测峰值 GIF 738 MB、WebP 871 MB、APNG 1149 MB）
+FRAME_ENCODE_COPIES = {"GIF": 1.5, "WEBP": 1.5, "PNG": 2.0, "TIFF": 0}
+
+
+def read_header(path, count_frames=True):
+    """只解析文件头，返回 (宽高, 格式, 帧数)；无法识别时返回 None
+
+    只有可能含多帧的格式才数帧，GIF 要扫描整个文件（不解码像素，大动图也要上百毫秒），
+    其余格式只读帧数表或页头。只需要宽高时传 count_frames=False，帧数记为 1。
+    """
+    try:
+        with Image.open(path) as im:
+            frames = 1
+            if count_frames and im.format in MULTIFRAME_FORMATS:
+                frames = getattr(im, "n_frames", 1)
+            return im.size, im.format, frames
+    except (OSError, ValueError, Image.DecompressionBombError):
+        return None
+
+
+def draft_reduction(source_size, fmt, size):
+    """估计 JPEG 用 draft 缩小解码时的缩小倍数（1、2、4 或 8），其余格式为 1"""
+    if fmt != "JPEG" or size is None:
+        return 1
+    need = (size[0] * DRAFT_REDUCING_GAP, size[1] * DRAFT_REDUCING_GAP)
+    for scale in (8, 4, 2):
+        if source_size[0] / scale >= need[0] and source_size[1] / scale >= need[1]:
+            return scale
+    return 1
+
+
+def estimate_job_bytes(header, settings):
+    """按文件头估计一个导出任务的峰值内存（字节），settings 为多规格导出的目标列表时按全部输出计
+
+    取各阶段的最大值：转换时解码图和 RGBA 副本同时存在，缩放时解码图和输出图同时存在，
+    保存为 JPEG 等格式时 RGBA 输出图还要再转换一次；numpy 后端和分块模式保持 RGB，没有这两份副本。
+    """
+    if header is None:
+        return JOB_OVERHEAD_BYTES
+    source_size, fmt, frames = header
+    targets = settings if isinstance(settings, list) else [settings]
+    if frames > 1 and any(t["format"] in MULTIFRAME_FORMATS for t in targets):
+        return PIXEL_BYTES * estimate_frame_pixels(source_size, frames, targets) + JOB_OVERHEAD_BYTES
+    sizes = [target_size(source_size, t["scale_mode"], t["scale_value"]) or source_size for t in targets]
+    largest = (max(w for w, _ in sizes), max(h for _, h in sizes))
+    reduction = draft_reduction(source_size, fmt, None if largest == source_size else largest)
+    decoded = (source_size[0] // reduction) * (source_size[1] // reduction)
+    output = sum(w * h for w, h in sizes)
+    native = all(t["backend"] == "numpy" or use_tiled(source_size, t) for t in targets)
+    copies = 1 if native else 2
+    peak = max(decoded * copies, decoded + output if largest != source_size else 0, output * copies)
+    return PIXEL_BYTES * peak + JOB_OVERHEAD_BYTES
+
+
+def estimate_frame_pixels(source_size, frames, targets):
+    """多帧导出的峰值像素数：各目标依次处理，取最大的一个
+
+    同时在内存中的帧至多 FRAME_CHUNK 个加上线程池中正在合成的帧，每帧有解码图和输出图；
+    导出为 GIF、APNG 或 WebP 时所有输出帧要先收齐（另有编码器的副本，见 FRAME_ENCODE_COPIES），
+    导出为 TIFF 时逐页写出、不保留。
+    多页 TIFF 各页尺寸可能不同，按第一页估计。
+    """
+    source = source_size[0] * source_size[1]
+    in_flight = min(frames, FRAME_CHUNK + FRAME_WORKERS)
+    peak = source  # 导出为 JPEG 的目标只处理第一帧
+    for t in targets:
+        w, h = target_size(source_size, t["scale_mode"], t["scale_value"]) or source_size
+        output = w * h
+        if t["format"] not in MULTIFRAME_FORMATS:
+            peak = max(peak, 2 * (source + output))
+            continue
+        kept = frames * output * FRAME_ENCODE_COPIES[t["format"]]
+        peak = max(peak, in_flight * (source + output) + int(kept))
+    return peak
+
+
+def default_memory_budget():
+    """默认内存预算为物理内存的一半，无法获取物理内存大小时（如 Windows）返回 None"""
+    try:
+        return os.sysconf("SC_PAGE_SIZE") * os.sysconf("SC_PHYS_PAGES") // 2
+    except (AttributeError, ValueError, OSError):
+        return None
+
+
+def _run_budgeted(paths, out_dir, settings, workers, ordered, cancel_event, trace, job, memory_budget, order):
+    """按内存预算放行任务：正在处理的任务估计内存之和不超过 memory_budget
+
+    先读取所有文件头估计每个任务的内存，按 order（input 原顺序、large 大图优先、small 小图优先）
+    排队；队首任务放不下时等待有任务完成，不越过它先放行后面的任务，大图不会一直排不上。
+    单个任务超过预算时等其他任务都完成后单独处理。ordered=True 时结果仍按 paths 的顺序产出。
+    """
+    with ThreadPoolExecutor() as pool:
+        costs = [estimate_job_bytes(header, settings) for header in pool.map(read_header, paths)]
+    queue = list(range(len(paths)))
+    if order in ("large", "small"):
+        queue.sort(key=lambda i: costs[i], reverse=order == "large")
+    queue = deque(queue)
+    budget = memory_budget or float("inf")
+    running = {}
+    used = 0
+    done = {}
+    next_index = 0
+    with ProcessPoolExecutor(max_workers=min(workers, len(paths))) as executor:
+        try:
+            while queue or running:
+                if cancel_event is not None and cancel_event.is_set():
+                    return
+                while queue and len(running) < workers and (not running or used + costs[queue[0]] <= budget):
+                    i = queue.popleft()
+                    running[executor.submit(job, paths[i], out_dir, settings, trace)] = i
+                    used += costs[i]
+                finished, _ = wait(running, return_when=FIRST_COMPLETED)
+                for future in finished:
+                    i = running.pop(future)
+                    used -= costs[i]
+                    if not ordered:
+                        yield future.result()
+                    else:
+                        done[i] = future.result()
+                while next_index in done:
+                    yield done.pop(next_index)
+                    next_index += 1
+        finally:
+            for future in running:
+                future.cancel()
+
+
+def _run_jobs(paths, out_dir, settings, workers, ordered, cancel_event=None, trace=False, job=process_job,
+              memory_budget=None, order=None):
+    if not paths:
+        return
+    workers = workers or os.cpu_count() or 1
+    if workers == 1 or len(paths) <= 1:
+        for path in paths:
+            if cancel_event is not None and cancel_event.is_set():
+                return
+            yield job(path, out_dir, settings, trace)
+        return
+    if memory_budget or order in ("large", "small"):
+        yield from _run_budgeted(paths, out_dir, settings, workers, ordered, cancel_event, trace, job,
+                                 memory_budget, order)
+        return
+
+    with ProcessPoolExecutor(max_workers=min(workers, len(paths))) as executor:
+        futures = [executor.submit(job, path, out_dir, settings, trace) for path in paths]
+        try:
+            for future in (futures if ordered else as_completed(futures)):
+                if cancel_event is not None and cancel_event.is_set():
+                    break
+                yield future.result()
+        finally:
+            # 取消或提前结束时丢弃还没开始的任务，退出 with 时只等待正在运行的任务
+            for future in futures:
+                future.cancel()
+
+
+# ===== 多规格导出 =====
+def rendition_settings(templates, targets, profiles=None, base=None):
+    """把多规格导出的目标列表展开为各自的完整设置
+
+    每个目标可用 template 引用模板，没有引用时以 base 为基础；
+    其余字段（scale_mode、scale_value、format、encoder 等）覆盖模板。
+    没有写 suffix 的缩放目标自动在后缀后加上缩放方式和数值；输出文件名重复时报错。
+    """
+    profiles = profiles or load_encoder_profiles(templates)
+    result = []
+    names = set()
+    for target in targets:
+        target = dict(target)
+        name = target.pop("template", None)
+        if name is not None and (name not in templates or name.startswith("_")):
+            raise ValueError(f"模板不存在：{name}")
+        suffix = target.pop("suffix", None)
+        tpl = dict(templates[name] if name else base or {})
+        tpl.update(target)
+        settings = normalize_settings(tpl, profiles)
+        if suffix is None and settings["scale_mode"] != "none":
+            suffix = f"{settings['suffix']}_{settings['scale_mode']}{settings['scale_value']}"
+        if suffix is not None:
+            settings["suffix"] = suffix
+        key = (settings["prefix"], settings["suffix"], settings["format"])
+        if key in names:
+            raise ValueError(f"多规格导出中有重名的输出（后缀 {settings['suffix']}），请为目标设置不同的 suffix")
+        names.add(key)
+        result.append(settings)
+    return result
+
+
+def resize_chain(img, sizes):
+    """从大到小逐级缩放，返回 {尺寸: 图像}
+
+    每个尺寸从已生成的、宽高都至少是它 DRAFT_REDUCING_GAP 倍的最小中间图缩得，
+    没有合适的中间图时从 img 缩得；与 img 同尺寸的直接使用 img。
+    """
+    buffers = {}
+    for size in sorted(set(sizes), key=lambda s: s[0] * s[1], reverse=True):
+        parent = img
+        for other, buf in buffers.items():
+            if (other[0] >= size[0] * DRAFT_REDUCING_GAP and other[1] >= size[1] * DRAFT_REDUCING_GAP
+                    and other[0] * other[1] < parent.width * parent.height):
+                parent = buf
+        buffers[size] = parent if parent.size == size else parent.resize(size, Image.LANCZOS)
+    return buffers
+
+
+def process_renditions(path, out_dir, targets, timer=NULL_TIMER):
+    """一次解码生成多个规格的输出，返回 [(输出路径, 编码耗时, 输出大小)]
+
+    源图按最大的目标尺寸缩小解码并只转换一次，各尺寸由 resize_chain 逐级缩得，
+    同尺寸的目标共用一张缩放结果，最后一个使用者直接在其上合成。
+    """
+    outputs = []
+    if is_multiframe(path):
+        # 多帧图像逐个目标分别处理，每个目标都要重新解码全部帧；导出为 JPEG 的目标只取第一帧，仍走下面的流程
+        single = []
+        for settings in targets:
+            if settings["format"] not in MULTIFRAME_FORMATS:
+                single.append(settings)
+                continue
+            start = time.perf_counter()
+            out_path = process_frames(path, out_dir, settings, timer)
+            outputs.append((out_path, time.perf_counter() - start, os.path.getsize(out_path)))
+        if not single:
+            return outputs
+        targets = single
+    with timer.stage("open"):
+        im = Image.open(path)
+    img = None
+    try:
+        source_size = im.size
+        sizes = [target_size(source_size, t["scale_mode"], t["scale_value"]) or source_size for t in targets]
+        with timer.stage("decode"):
+            largest = (max(w for w, _ in sizes), max(h for _, h in sizes))
+            im.draft(None, (int(largest[0] * DRAFT_REDUCING_GAP), int(largest[1] * DRAFT_REDUCING_GAP)))
+            im.load()
+        with timer.stage("convert"):
+            # 只有所有目标都能在 RGB 上合成（numpy 后端或分块模式）时才保留 RGB
+            native = all(t["backend"] == "numpy" or use_tiled(source_size, t) for t in targets)
+            mode = native_mode(im) if native else "RGBA"
+            img = im if im.mode == mode else im.convert(mode)
+    finally:
+        if img is not im:
+            im.close()
+    # draft 缩小解码后原图尺寸的目标也要从 img 缩放
+    sizes = [img.size if size == source_size else size for size in sizes]
+    buffers = {}
+    try:
+        with timer.stage("resize"):
+            buffers = resize_chain(img, sizes)
+        timer.count(source_pixels=source_size[0] * source_size[1], output_pixels=sum(w * h for w, h in sizes))
+        remaining = Counter(sizes)
+        for settings, size in zip(targets, sizes):
+            remaining[size] -= 1
+            tile_size = TILE_SIZE if use_tiled(source_size, settings) else None
+            out_img = watermark_for_size(buffers[size], settings, source_size, tile_size=tile_size,
+                                         in_place=remaining[size] == 0, timer=timer)
+            out_path = output_path_for(path, out_dir, settings)
+            start = time.perf_counter()
+            with timer.stage("encode"):
+                save_atomic(out_img, out_path, settings["format"], settings["encoder_options"])
+            outputs.append((out_path, time.perf_counter() - start, os.path.getsize(out_path)))
+            if remaining[size] == 0:
+                buffers.pop(size).close()
+    finally:
+        for buf in buffers.values():
+            buf.close()
+        img.close()
+    timer.count(bytes_read=os.path.getsize(path), bytes_written=sum(size for _, _, size in outputs))
+    return outputs
+
+
+def renditions_job(path, out_dir, targets, trace=False):
+    """多规格导出单个源文件，返回每个目标的 ExportResult；trace 时统计附在最后一个结果上"""
+    timer = StageTimer(path)
+    try:
+        for settings in targets:
+            check_backend(settings)
+        outputs = process_renditions(path, out_dir, targets, timer)
+    except Exception as e:
+        return [ExportResult(path, None, f"{type(e).__name__}: {e}", False)]
+    results = [ExportResult(path, out_path, None, False, None, encode_s, out_bytes)
+               for out_path, encode_s, out_bytes in outputs]
+    if trace:
+        results[-1] = results[-1]._replace(stats=timer.to_dict())
+    return results
+
+
+def export_renditions(paths, out_dir, targets, workers=None, ordered=True, cancel_event=None, trace=False,
+                      memory_budget=None, order=None):
+    """多规格批量导出：每个源文件只解码一次，逐个产出该文件所有目标的 ExportResult 列表
+
+    targets 为 rendition_settings() 的结果；其余参数同 export_batch，内存按全部目标的输出估计。
+    """
+    paths = list(paths)
+    conflict = check_output_dir(paths, out_dir)
+    if conflict:
+        raise ValueError(f"文件 {os.path.basename(conflict)} 位于输出目录中，导出已取消！")
+    duplicate = check_output_names(paths, out_dir, targets)
+    if duplicate:
+        raise ValueError(duplicate_output_error(duplicate))
+    os.makedirs(out_dir, exist_ok=True)
+    yield from _run_jobs(paths, out_dir, targets, workers, ordered, cancel_event, trace, job=renditions_job,
+                         memory_budget=memory_budget, order=order)
+
+
+def collect_images(inputs):
+    """展开命令行输入：文件直接保留，目录取其中受支持格式的图片"""
+    files = []
+    for item in inputs:
+        if os.path.isdir(item):
+            files.extend(os.path.join(item, f) for f in sorted(os.listdir(item))
+                         if os.path.splitext(f)[1].lower() in SUPPORTED_FORMATS)
+        elif os.path.isfile(item):
+            files.append(item)
+        else:
+            print(f"❌ 找不到输入：{item}")
+    return files
+
+
+# ===== 命令行入口 =====
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="批量添加文字水印（无界面，多进程）")
+    parser.add_argument("inputs", nargs="+", help="图片文件或文件夹")
+    parser.add_argument("-o", "--output", required=True, help="导出文件夹")
+    parser.add_argument("-t", "--template", help="templates.json 中的模板名称，默认使用上一次的模板")
+    parser.add_argument("--templates", default=TEMPLATE_FILE, help="模板文件路径")
+    parser.add_argument("--text", help="覆盖模板中的水印文字")
+    parser.add_argument("--format", type=str.upper, choices=OUTPUT_FORMATS, default=None, help="覆盖模板中的导出格式")
+    parser.add_argument("--encoder", default=None,
+                        help="编码档位：fast（速度优先）、default、archive（体积优先）或模板文件中自定义的档位")
+    parser.add_argument("--font-quantize", type=float, default=None,
+                        help="字号分档比例，如 0.05 表示相邻档位相差约 5%%，0 为不分档")
+    parser.add_argument("--tiled", choices=["auto", "on", "off"], default=None,
+                        help="分块低内存模式，auto 时超过 %d 万像素自动启用" % (TILED_MIN_PIXELS // 10000))
+    parser.add_argument("--backend", choices=["pil", "numpy"], default=None,
+                        help="水印合成后端：pil 在 RGBA 图像上合成；numpy 直接混合进 RGB 图像，省去整幅 RGBA 转换")
+    parser.add_argument("--renditions", metavar="NAME",
+                        help="按 templates.json 中 _renditions 的多规格列表导出，每张图片只解码一次")
+    parser.add_argument("-j", "--workers", type=int, default=None, help="进程数，默认 CPU 核数")
+    parser.add_argument("--unordered", action="store_true", help="按完成先后输出结果")
+    parser.add_argument("--memory-budget", type=float, default=None, metavar="MB",
+                        help="同时处理的图片估计内存之和的上限（MB），默认物理内存的一半，0 为不限制")
+    parser.add_argument("--order", choices=JOB_ORDERS, default="input",
+                        help="开始处理的顺序：input 按输入顺序，large 大图优先，small 小图优先")
+    parser.add_argument("--incremental", action="store_true",
+                        help="增量导出：跳过源文件和设置都未变化的图片，并报告孤立的输出文件")
+    parser.add_argument("--content-hash", action="store_true",
+                        help="增量导出时用文件内容的 SHA-256 而不是大小和修改时间判断源文件是否变化")
+    parser.add_argument("--trace", metavar="JSONL",
+                        help="记录每张图片各阶段耗时和读写字节数到 JSON Lines 文件，并在结束时打印汇总")
+    parser.add_argument("--profile", metavar="PROF",
+                        help="只处理第一张图片，用 cProfile 和 tracemalloc 剖析，结果保存到该文件")
+    args = parser.parse_args(argv)
+
+    templates = load_templates(args.templates)
+    name = args.template or templates.get("_last_used")
+    if args.template and (args.template not in templates or args.template.startswith("_")):
+        print(f"❌ 模板不存在：{args.template}")
+        return 1
+    profiles = load_encoder_profiles(templates)
+    if args.encoder and args.encoder not in profiles:
+        print(f"❌ 编码档位不存在：{args.encoder}（可选：{'、'.join(profiles)}）")
+        return 1
+    settings = normalize_settings(templates.get(name) if name else None, profiles, text=args.text,
+                                  format=args.format, encoder=args.encoder,
+                                  font_quantize=args.font_quantize, tiled=args.tiled, backend=args.backend)
+    targets = None
+    try:
+        check_settings(settings)
+        check_backend(settings)
+        if args.renditions:
+            spec = templates.get("_renditions", {}).get(args.renditions)
+            if not spec:
+                raise ValueError(f"多规格列表不存在：{args.renditions}")
+            # 命令行上的覆盖项作用于每个目标
+            overrides = {k: v for k, v in [("text", args.text), ("encoder", args.encoder),
+                                           ("font_quantize", args.font_quantize), ("tiled", args.tiled),
+                                           ("backend", args.backend)] if v is not None}
+            targets = rendition_settings(templates, [{**target, **overrides} for target in spec], profiles,
+                                         base=settings)
+            for target in targets:
+                check_settings(target)
+                check_backend(target)
+    except (RuntimeError, ValueError) as e:
+        print(f"❌ {e}")
+        return 1
+
+    files = collect_images(args.inputs)
+    if not files:
+        print("❌ 没有可处理的图片")
+        return 1
+
+    if args.profile:
+        os.makedirs(args.output, exist_ok=True)
+        timer = StageTimer(files[0])
+        profile_call(process_file, files[0], args.output, settings, timer, prof_path=args.profile)
+        print(format_summary(summarize([timer.to_dict()])))
+        return 0
+
+    manifest = None
+    if targets is not None and (args.incremental or args.content_hash):
+        print("⚠️ 多规格导出不支持增量导出，将全部重新导出")
+    elif args.incremental or args.content_hash:
+        os.makedirs(args.output, exist_ok=True)
+        manifest = ExportManifest(args.output)
+
+    if args.memory_budget is None:
+        memory_budget = default_memory_budget()
+    else:
+        memory_budget = int(args.memory_budget * 1024 * 1024) or None
+    trace = TraceWriter(args.trace) if args.trace else None
+    count = failed = skipped = 0
+    try:
+        if targets is not None:
+            batches = export_renditions(files, args.output, targets, workers=args.workers,
+                                        ordered=not args.unordered, trace=trace is not None,
+                                        memory_budget=memory_budget, order=args.order)
+        else:
+            batches = ([result] for result in export_batch(files, args.output, settings, workers=args.workers,
+                                                           ordered=not args.unordered, manifest=manifest,
+                                                           content_hash=args.content_hash,
+                                                           trace=trace is not None,
+                                                           memory_budget=memory_budget, order=args.order))
+        for results in batches:
+            for result in results:
+                if result.error:
+                    failed += 1
+                    print(f"❌ {os.path.basename(result.path)} -> {result.error}")
+                elif result.skipped:
+                    skipped += 1
+                else:
+                    count += 1
+                    print(f"✅ {os.path.basename(result.path)} 已保存到 {result.out_path}"
+                          f"（编码 {result.encode_s * 1000:.0f} ms，{result.out_bytes / 1e6:.2f} MB）")
+                if trace is not None and result.stats:
+                    trace.write(result.stats)
+    except ValueError as e:
+        print(f"❌ {e}")
+        return 1
+    finally:
+        if trace is not None:
+            trace.close()
+    print(f"导出完成：成功 {count} 张，未变化跳过 {skipped} 张，失败 {failed} 张")
+    if trace is not None and trace.records:
+        print(format_summary(summarize(trace.records)))
+    if manifest is not None:
+        for name in manifest.orphans():
+            print(f"⚠️ 孤立的输出文件（源文件已不在本次导出中）：{name}")
+    return 1 if failed else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,373 @@
+import io
+import os
+import sys
+import json
+import time
+import asyncio
+import argparse
+from collections import deque
+from email.parser import BytesParser
+from email.policy import HTTP
+from urllib.parse import urlsplit, parse_qs
+from concurrent.futures import ProcessPoolExecutor
+from PIL import Image, UnidentifiedImageError
+
+import watermark_engine as engine
+from watermark_engine import TEMPLATE_FILE
+from instrument import percentile
+
+DEFAULT_PORT = 8765
+DEFAULT_QUEUE_LIMIT = 16
+MAX_BODY = 256 * 1024 * 1024
+# 单个请求按文件头估计的渲染内存上限；压缩率很高的小文件也可能解码出数 GB 的图像
+DEFAULT_MAX_RENDER_MB = 1024
+KEEPALIVE_TIMEOUT = 15
+STREAM_CHUNK = 64 * 1024
+LATENCY_WINDOW = 1000  # /metrics 中的分位数按最近这么多个请求计算
+CONTENT_TYPES = {"PNG": "image/png", "JPEG": "image/jpeg", "WEBP": "image/webp", "GIF": "image/gif",
+                 "TIFF": "image/tiff"}
+REASONS = {100: "Continue", 200: "OK", 400: "Bad Request", 404: "Not Found", 405: "Method Not Allowed",
+           411: "Length Required", 413: "Payload Too Large", 415: "Unsupported Media Type",
+           500: "Internal Server Error", 503: "Service Unavailable"}
+
+
+class HTTPError(Exception):
+    def __init__(self, status, message):
+        super().__init__(message)
+        self.status = status
+
+
+# ===== 渲染（在工作进程中运行） =====
+def render_bytes(data, settings):
+    """解码上传的图片、缩放、加水印并按设置编码，返回 (编码后的字节, 渲染耗时)"""
+    start = time.perf_counter()
+    if engine.exports_frames(io.BytesIO(data), settings):
+        # 动图和多页 TIFF 逐帧加水印，保留时长和循环次数
+        buf = io.BytesIO()
+        with Image.open(io.BytesIO(data)) as im:
+            engine.encode_frames(im, buf, settings)
+        return buf.getvalue(), time.perf_counter() - start
+    img, source_size = engine.open_for_export(io.BytesIO(data), settings)
+    try:
+        tile_size = engine.TILE_SIZE if engine.use_tiled(source_size, settings) else None
+        out_img = engine.watermark_for_size(img, settings, source_size, tile_size=tile_size, in_place=True)
+        buf = io.BytesIO()
+        engine.save_image(out_img, buf, settings["format"], settings["encoder_options"])
+    finally:
+        img.close()
+    return buf.getvalue(), time.perf_counter() - start
+
+
+# ===== 请求解析 =====
+async def read_request(reader):
+    """读取一个 HTTP/1.1 请求的请求行和头部，连接已关闭时返回 None；请求体由调用方读取"""
+    line = await reader.readline()
+    if not line:
+        return None
+    try:
+        method, target, version = line.decode("latin-1").split()
+    except ValueError:
+        raise HTTPError(400, "请求行格式错误")
+    # curl 等客户端会把查询参数中的中文按 UTF-8 原样发送，不做百分号编码
+    target = target.encode("latin-1").decode("utf-8", "replace")
+    headers = {}
+    while True:
+        line = await reader.readline()
+        if line in (b"\r\n", b"\n", b""):
+            break
+        name, _, value = line.decode("latin-1").partition(":")
+        headers[name.strip().lower()] = value.strip()
+    return method.upper(), target, version.upper(), headers
+
+
+def parse_upload(headers, query, body):
+    """从请求中取出图片字节、模板名和内联设置
+
+    支持两种上传方式：请求体直接是图片，模板名和设置放在查询参数 template、settings 中；
+    或 multipart/form-data，字段 image 为图片，template、settings 为普通字段。
+    """
+    fields = {key: values[0] for key, values in query.items()}
+    content_type = headers.get("content-type", "")
+    if content_type.startswith("multipart/form-data"):
+        message = BytesParser(policy=HTTP).parsebytes(
+            f"Content-Type: {content_type}\r\n\r\n".encode("latin-1") + body)
+        image = None
+        for part in message.iter_parts():
+            name = part.get_param("name", header="content-disposition")
+            payload = part.get_payload(decode=True) or b""
+            if name == "image":
+                image = payload
+            elif name:
+                fields[name] = payload.decode("utf-8")
+    else:
+        image = body
+    if not image:
+        raise HTTPError(400, "缺少图片数据")
+    inline = {}
+    if fields.get("settings"):
+        try:
+            inline = json.loads(fields["settings"])
+        except ValueError:
+            raise HTTPError(400, "settings 不是合法的 JSON")
+        if not isinstance(inline, dict):
+            raise HTTPError(400, "settings 必须是 JSON 对象，字段与 templates.json 中的模板一致")
+    return image, fields.get("template"), inline
+
+
+# ===== 服务 =====
+class WatermarkServer:
+    """在进程池中渲染水印的 HTTP 服务
+
+    同时渲染的请求数不超过 workers，另有至多 queue_limit 个请求排队等待，
+    再多的请求直接返回 503，避免上传的图片在内存中无限堆积。
+    """
+
+    def __init__(self, workers=None, queue_limit=DEFAULT_QUEUE_LIMIT, templates_path=TEMPLATE_FILE,
+                 max_render_bytes=DEFAULT_MAX_RENDER_MB * 1024 * 1024):
+        self.workers = workers or os.cpu_count() or 1
+        self.max_render_bytes = max_render_bytes
+        self.queue_limit = queue_limit
+        self.templates_path = templates_path
+        self._templates = ({}, None)
+        self.pool = None
+        self.pending = 0  # 已接纳、尚未响应完的上传请求数
+        self.rendering = 0  # 已提交到进程池的请求数
+        self.started = time.time()
+        self.counts = {"requests": 0, "rendered": 0, "errors": 0, "rejected": 0}
+        self.latencies = deque(maxlen=LATENCY_WINDOW)
+        self.render_times = deque(maxlen=LATENCY_WINDOW)
+
+    def templates(self):
+        """templates.json 修改后自动重新读取"""
+        try:
+            mtime = os.stat(self.templates_path).st_mtime_ns
+        except OSError:
+            return {}
+        if self._templates[1] != mtime:
+            self._templates = (engine.load_templates(self.templates_path), mtime)
+        return self._templates[0]
+
+    def resolve_settings(self, name, inline):
+        templates = self.templates()
+        tpl = {}
+        if name:
+            if name not in templates or name.startswith("_"):
+                raise HTTPError(404, f"模板不存在：{name}")
+            tpl.update(templates[name])
+        tpl.update(inline)
+        try:
+            settings = engine.normalize_settings(tpl, engine.load_encoder_profiles(templates))
+            engine.check_settings(settings)
+        except (TypeError, ValueError, AttributeError, KeyError) as e:
+            raise HTTPError(400, f"设置无效：{e}")
+        if settings["format"] not in CONTENT_TYPES:
+            raise HTTPError(400, f"不支持的导出格式：{settings['format']}")
+        try:
+            engine.check_backend(settings)
+        except RuntimeError as e:
+            raise HTTPError(400, str(e))
+        return settings
+
+    def check_size(self, image, settings):
+        """只读文件头估计渲染所需内存，超过上限的请求不提交到进程池"""
+        header = engine.read_header(io.BytesIO(image))
+        if header is None:
+            raise HTTPError(415, "无法识别的图片")
+        needed = engine.estimate_job_bytes(header, settings)
+        if self.max_render_bytes and needed > self.max_render_bytes:
+            (width, height), _, frames = header
+            size = f"{width}x{height}" + (f"，{frames} 帧" if frames > 1 else "")
+            raise HTTPError(413, f"图片过大（{size}），估计需要 {needed // (1024 * 1024)} MB 内存，"
+                                 f"上限 {self.max_render_bytes // (1024 * 1024)} MB")
+
+    def metrics(self):
+        latencies = sorted(self.latencies)
+        render_times = sorted(self.render_times)
+        return {
+            **self.counts,
+            "uptime_s": round(time.time() - self.started, 1),
+            "workers": self.workers,
+            "queue_limit": self.queue_limit,
+            "in_progress": min(self.rendering, self.workers),
+            "queue_depth": self.pending - min(self.rendering, self.workers),
+            "latency_ms": {q: round(percentile(latencies, v) * 1000, 1)
+                           for q, v in (("p50", 0.50), ("p95", 0.95), ("p99", 0.99))},
+            "render_ms": {q: round(percentile(render_times, v) * 1000, 1)
+                          for q, v in (("p50", 0.50), ("p95", 0.95), ("p99", 0.99))},
+        }
+
+    async def render(self, image, settings):
+        loop = asyncio.get_running_loop()
+        self.rendering += 1
+        try:
+            data, elapsed = await loop.run_in_executor(self.pool, render_bytes, image, settings)
+        finally:
+            self.rendering -= 1
+        self.render_times.append(elapsed)
+        return data
+
+    # ----- 连接处理 -----
+    async def handle_connection(self, reader, writer):
+        try:
+            while True:
+                try:
+                    request = await asyncio.wait_for(read_request(reader), KEEPALIVE_TIMEOUT)
+                except (asyncio.TimeoutError, asyncio.IncompleteReadError, ConnectionError):
+                    break
+                except (HTTPError, ValueError) as e:
+                    await send_json(writer, getattr(e, "status", 400), {"error": str(e)}, keep_alive=False)
+                    break
+                if request is None:
+                    break
+                keep_alive = await self.handle_request(reader, writer, *request)
+                if not keep_alive:
+                    break
+        except (ConnectionError, asyncio.IncompleteReadError):
+            pass
+        finally:
+            writer.close()
+
+    async def handle_request(self, reader, writer, method, target, version, headers):
+        """处理一个请求，返回连接是否保持"""
+        start = time.perf_counter()
+        self.counts["requests"] += 1
+        url = urlsplit(target)
+        connection = headers.get("connection", "").lower()
+        keep_alive = connection != "close" if version == "HTTP/1.1" else connection == "keep-alive"
+        has_body = headers.get("content-length", "0") != "0" or "transfer-encoding" in headers
+        body_read = False
+        try:
+            if url.path == "/metrics":
+                if method != "GET":
+                    raise HTTPError(405, "只支持 GET")
+                await send_json(writer, 200, self.metrics(), keep_alive)
+                return keep_alive
+            if url.path != "/watermark":
+                raise HTTPError(404, f"没有这个接口：{url.path}")
+            if method != "POST":
+                raise HTTPError(405, "只支持 POST")
+            if "content-length" not in headers:
+                raise HTTPError(411, "需要 Content-Length")
+            try:
+                length = int(headers["content-length"])
+            except ValueError:
+                raise HTTPError(400, "Content-Length 无效")
+            if length > MAX_BODY:
+                raise HTTPError(413, f"图片超过 {MAX_BODY // (1024 * 1024)} MB")
+            # 在读取请求体之前判断是否超过排队上限，被拒绝的请求不必上传图片
+            if self.pending >= self.workers + self.queue_limit:
+                self.counts["rejected"] += 1
+                raise HTTPError(503, "服务繁忙，请稍后重试")
+            # 从接纳到响应写完一直占用名额，上传中、排队中和渲染中的请求都计入
+            self.pending += 1
+            try:
+                if headers.get("expect", "").lower() == "100-continue":
+                    writer.write(b"HTTP/1.1 100 Continue\r\n\r\n")
+                body = await reader.readexactly(length)
+                body_read = True
+                image, name, inline = parse_upload(headers, parse_qs(url.query), body)
+                settings = self.resolve_settings(name, inline)
+                self.check_size(image, settings)
+                try:
+                    data = await self.render(image, settings)
+                except (UnidentifiedImageError, Image.DecompressionBombError) as e:
+                    raise HTTPError(415, f"无法识别的图片：{e}")
+                except Exception as e:
+                    raise HTTPError(500, f"{type(e).__name__}: {e}")
+                await send_stream(writer, data, CONTENT_TYPES[settings["format"]], keep_alive,
+                                  chunked=version == "HTTP/1.1")
+            finally:
+                self.pending -= 1
+            self.counts["rendered"] += 1
+            return keep_alive
+        except HTTPError as e:
+            if e.status != 503:
+                self.counts["errors"] += 1
+            # 请求体没有读取时无法继续复用连接
+            keep_alive = keep_alive and (body_read or not has_body)
+            await send_json(writer, e.status, {"error": str(e)}, keep_alive)
+            return keep_alive
+        finally:
+            if url.path == "/watermark":
+                self.latencies.append(time.perf_counter() - start)
+
+    async def serve(self, host, port):
+        with ProcessPoolExecutor(max_workers=self.workers) as pool:
+            self.pool = pool
+            server = await asyncio.start_server(self.handle_connection, host, port)
+            print(f"水印服务已启动：http://{host}:{port}/watermark ，指标：/metrics，"
+                  f"{self.workers} 个进程，排队上限 {self.queue_limit}")
+            async with server:
+                await server.serve_forever()
+
+
+# ===== 响应 =====
+def _head(status, headers, keep_alive):
+    lines = [f"HTTP/1.1 {status} {REASONS.get(status, '')}"]
+    lines += [f"{name}: {value}" for name, value in headers.items()]
+    lines.append("Connection: " + ("keep-alive" if keep_alive else "close"))
+    if status == 503:
+        lines.append("Retry-After: 1")
+    return ("\r\n".join(lines) + "\r\n\r\n").encode("latin-1")
+
+
+async def send_json(writer, status, payload, keep_alive=True):
+    body = json.dumps(payload, ensure_ascii=False).encode("utf-8")
+    writer.write(_head(status, {"Content-Type": "application/json; charset=utf-8",
+                                "Content-Length": len(body)}, keep_alive) + body)
+    await writer.drain()
+
+
+async def send_stream(writer, data, content_type, keep_alive=True, chunked=True):
+    """分段写出结果，每段等待发送缓冲区排空，慢速客户端不会让整张图堆在缓冲区里
+
+    HTTP/1.1 用分块传输编码；HTTP/1.0 不支持分块（chunked=False），改为给出 Content-Length。
+    """
+    if chunked:
+        writer.write(_head(200, {"Content-Type": content_type, "Transfer-Encoding": "chunked"}, keep_alive))
+    else:
+        writer.write(_head(200, {"Content-Type": content_type, "Content-Length": len(data)}, keep_alive))
+    view = memoryview(data)
+    for offset in range(0, len(view), STREAM_CHUNK):
+        chunk = view[offset:offset + STREAM_CHUNK]
+        if chunked:
+            writer.write(b"%x\r\n" % len(chunk))
+            writer.write(chunk)
+            writer.write(b"\r\n")
+        else:
+            writer.write(chunk)
+        await writer.drain()
+    if chunked:
+        writer.write(b"0\r\n\r\n")
+        await writer.drain()
+
+
+# ===== 命令行入口 =====
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="本地水印 HTTP 服务")
+    parser.add_argument("--host", default="127.0.0.1", help="监听地址，默认只接受本机连接")
+    parser.add_argument("--port", type=int, default=DEFAULT_PORT)
+    parser.add_argument("-j", "--workers", type=int, default=None, help="渲染进程数，默认 CPU 核数")
+    parser.add_argument("--queue-limit", type=int, default=DEFAULT_QUEUE_LIMIT,
+                        help="渲染进程都忙时最多排队的请求数，超出时返回 503")
+    parser.add_argument("--templates", default=TEMPLATE_FILE, help="模板文件路径")
+    parser.add_argument("--max-render-memory", type=float, default=DEFAULT_MAX_RENDER_MB, metavar="MB",
+                        help="单个请求按文件头估计的渲染内存上限（MB），超出时返回 413，0 为不限制")
+    args = parser.parse_args(argv)
+
+    try:
+        engine.find_font_path()
+    except RuntimeError as e:
+        print(f"❌ {e}")
+        return 1
+    server = WatermarkServer(args.workers, args.queue_limit, args.templates,
+                             int(args.max_render_memory * 1024 * 1024))
+    try:
+        asyncio.run(server.serve(args.host, args.port))
+    except KeyboardInterrupt:
+        print("服务已停止")
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -1,33 +1,19 @@
 import os
 import sys
-from PIL import Image, ImageDraw, ImageFont, ExifTags
-from datetime import datetime
+from PIL import Image, ImageDraw, ImageFont
+from exif_date import CACHE_FILE, get_exif_date, scan_dates
 
 
 def get_exif_datetime(image_path):
-    """读取EXIF中的拍摄日期（年月日）"""
-    try:
-        image = Image.open(image_path)
-        exif_data = image._getexif()
-        if not exif_data:
-            return None
-
-        for tag_id, value in exif_data.items():
-            tag = ExifTags.TAGS.get(tag_id, tag_id)
-            if tag == "DateTimeOriginal":
-                try:
-                    dt = datetime.strptime(value, "%Y:%m:%d %H:%M:%S")
-                    return dt.strftime("%Y-%m-%d")
-                except Exception:
-                    return None
-        return None
-    except Exception:
-        return None
+    """读取EXIF中的拍摄日期（年月日），只读取文件头部的 APP1 段"""
+    return get_exif_date(image_path)
 
 
 def add_watermark(image_path, output_path, text, font_size, color, position):
     """在图片上添加水印并保存"""
-    image = Image.open(image_path).convert("RGB")
+    # 用 with 及时关闭源文件，批量处理时不会累积打开的文件句柄
+    with Image.open(image_path) as im:
+        image = im.convert("RGB")
     draw = ImageDraw.Draw(image)
 
     try:
@@ -37,7 +23,9 @@ def add_watermark(image_path, output_path, text, font_size, color, position):
         # 回退到内置字体
         font = ImageFont.load_default()
 
-    text_width, text_height = draw.textsize(text, font=font)
+    # Pillow 10 移除了 textsize，改用 textbbox 计算文字宽高
+    left, top, right, bottom = draw.textbbox((0, 0), text, font=font)
+    text_width, text_height = right - left, bottom - top
     width, height = image.size
 
     # 计算位置
@@ -77,14 +65,16 @@ def main():
     output_dir = input_dir.rstrip("/\\") + "_watermark"
     os.makedirs(output_dir, exist_ok=True)
 
-    for filename in os.listdir(input_dir):
-        filepath = os.path.join(input_dir, filename)
-        if not os.path.isfile(filepath):
-            continue
-        if not filename.lower().endswith((".jpg", ".jpeg", ".png")):
-            continue
+    filenames = [filename for filename in os.listdir(input_dir)
+                 if filename.lower().endswith((".jpg", ".jpeg", ".png"))
+                 and os.path.isfile(os.path.join(input_dir, filename))]
+    # 先并发扫描所有图片的拍摄日期，结果缓存在输出目录中，再次运行时未变的文件直接命中
+    dates = scan_dates([os.path.join(input_dir, f) for f in filenames],
+                       cache_path=os.path.join(output_dir, CACHE_FILE))
 
-        dt = get_exif_datetime(filepath)
+    for filename in filenames:
+        filepath = os.path.join(input_dir, filename)
+        dt = dates[filepath]
         if not dt:
             print(f"{filename} -> 无日期信息，跳过")
             continue